@@ -0,0 +1,718 @@
+"""
+Asyncio runtime: AsyncTeleBot handlers behind a plain ASGI webhook endpoint.
+
+Run with:  uvicorn async_main:app --host 0.0.0.0 --port $PORT
+
+Configuration, texts, the course catalog and the in-memory caches are shared
+with main.py; every network call (Telegram and Supabase) is awaited instead
+of blocking a thread, so one process can keep thousands of updates in flight.
+"""
+import asyncio
+import hashlib
+import heapq
+import os
+import time
+from datetime import datetime
+
+from supabase import acreate_client, AsyncClient
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+import main
+from main import (
+    ADMIN_DIGEST_WINDOW, ADMIN_FLUSH_TIMEOUT, ADMIN_HELP, ADMIN_IDS, BOT_TOKEN, BUCKET_NAME, BUY_MARKUP, CHANNEL_USERNAME, COURSE_UNAVAILABLE_REPLY,
+    COUNTERS, JOIN_MARKUP, JOIN_PROMPT, JOIN_REMINDER, MAX_UPLOAD_BYTES, MEMBER_CACHE,
+    MESSAGE_BUFFER_MAX, MESSAGE_DELETE_BATCH, MESSAGE_FLUSH_INTERVAL, MESSAGE_FLUSH_SIZE, MESSAGE_ROWS_DELETE_CHUNK,
+    PAID_MARKUP, PAYMENT_DEDUP_INDEX, PREMIUM_PAGE_SIZE, PROFILER, PROMO_MESSAGE, QR_CAPTION, QR_IMAGE_URL,
+    PRIORITY_ADMIN, PRIORITY_BULK, PRIORITY_USER, SEND_CHAT_BURST, SEND_CHAT_RATE, SEND_PROCESS_RATE,
+    UPGRADE_NOTICE, UPLOAD_DUPLICATE, UPLOAD_FOLDER_PREFIX, UPLOAD_NOT_REQUESTED, UPLOAD_PROMPT,
+    UPLOAD_RECEIVED, UPLOAD_TOO_LARGE, USER_CACHE, USER_NEGATIVE_TTL, USER_NOT_FOUND, WEBHOOK_URL,
+    current_catalog, group_messages_by_chat, is_admin, logger, payment_notice, profile_document, profile_seconds,
+    record_channel_membership, remember_payment, render_premium_page, replica_get_user, trace_command, _is_join_channel,
+)
+from repository import AsyncMessagesRepository, AsyncPaymentsRepository, AsyncUsersRepository, UserRow
+
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", "2000"))
+
+bot = AsyncTeleBot(BOT_TOKEN)
+supabase: AsyncClient = None  # created on ASGI startup (needs the running loop)
+users_repo: AsyncUsersRepository = None  # the repositories wrap it, so they are created then too
+payments_repo: AsyncPaymentsRepository = None
+messages_repo: AsyncMessagesRepository = None
+
+# -------------------------
+# Outbound Telegram send scheduler
+# -------------------------
+class AsyncOutboundScheduler(main.OutboundScheduler):
+    """asyncio twin of main.OutboundScheduler: same token buckets, priorities and 429 retries.
+
+    `submit` returns an awaitable future and `await outbox.send_message(...)`
+    returns the sent message. Jobs are dispatched by `run()`, a task started
+    on ASGI startup; each send runs as its own task.
+    """
+
+    def __init__(self, bot, global_rate, chat_rate, chat_burst):
+        super().__init__(bot, 0, global_rate, chat_rate, chat_burst)
+        self._wakeup = None  # asyncio.Event, created by run()
+
+    def submit(self, method, *args, priority=PRIORITY_USER, **kwargs):
+        job = main._SendJob(priority, self._chat_of(method, args, kwargs), method, args, kwargs)
+        with self._cond:
+            heapq.heappush(self._ready, (priority, next(self._seq), job))
+        self._wake()
+        return asyncio.wrap_future(job.future)
+
+    def call(self, method, *args, priority=PRIORITY_USER, **kwargs):
+        return self.submit(method, *args, priority=priority, **kwargs)
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _requeue(self, job, delay):
+        super()._requeue(job, delay)
+        self._wake()
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            with self._cond:
+                job, wait = self._take_job(time.monotonic())
+            if job is not None:
+                job.context.run(_spawn, self._send_async(job))  # the task inherits the submitter's context
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_async(self, job):
+        self._started(job)
+        main.record_span(f"outbox wait {job.method}", job.enqueued, time.monotonic())
+        try:
+            with main.trace_span(f"outbox {job.method}"):
+                result = await getattr(self.bot, job.method)(*job.args, **job.kwargs)
+        except Exception as e:
+            self._finished(job, error=e)
+            return
+        self._finished(job, result)
+
+
+outbox = AsyncOutboundScheduler(bot, SEND_PROCESS_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST)
+
+# -------------------------
+# Async data access
+# -------------------------
+_user_lookups = {}  # telegram_id -> asyncio.Task, coalesces concurrent misses
+_member_lookups = {}  # user_id -> asyncio.Task
+
+async def _fetch_user(telegram_id):
+    user = await users_repo.get_by_telegram_id(telegram_id)
+    if user:
+        USER_CACHE.set(telegram_id, user)
+    else:
+        USER_CACHE.set(telegram_id, USER_NOT_FOUND, ttl=USER_NEGATIVE_TTL)
+    return user
+
+async def _coalesced(lookups, key, factory):
+    task = lookups.get(key)
+    if task is None:
+        task = lookups[key] = asyncio.ensure_future(factory())
+        task.add_done_callback(lambda _: lookups.pop(key, None))
+    return await asyncio.shield(task)
+
+async def get_user_cached(telegram_id):
+    """Async twin of main.get_user_cached (same cache, same negative caching)."""
+    telegram_id = int(telegram_id)
+    cached = USER_CACHE.get(telegram_id)
+    if cached is USER_NOT_FOUND:
+        return None
+    if cached is not None:
+        return cached
+    replica_row = replica_get_user(telegram_id)
+    if replica_row is not None:
+        USER_CACHE.set(telegram_id, replica_row)
+        return replica_row
+    try:
+        return await _coalesced(_user_lookups, telegram_id, lambda: _fetch_user(telegram_id))
+    except Exception as e:
+        logger.warning("User lookup failed for %s: %s", telegram_id, e)
+        return None
+
+async def find_or_create_user(telegram_id, username, first_name=None, last_name=None):
+    telegram_id = int(telegram_id)
+    user = USER_CACHE.get(telegram_id)
+    if isinstance(user, UserRow):
+        if user.username == username and user.first_name == first_name:
+            return user
+        try:
+            await users_repo.update_profile(telegram_id, username, first_name, last_name)
+            user = user.with_profile(username, first_name)
+            USER_CACHE.set(telegram_id, user)
+        except Exception as e:
+            logger.warning("Profile update failed for %s: %s", telegram_id, e)
+        return user
+    user = await users_repo.register(telegram_id, username, first_name, last_name)
+    if user:
+        USER_CACHE.set(telegram_id, user)
+    return user
+
+async def is_member_of_channel(user_id):
+    cached = MEMBER_CACHE.get(int(user_id))
+    if cached is not None:
+        return cached
+
+    async def fetch():
+        cm = await bot.get_chat_member(CHANNEL_USERNAME, user_id)
+        joined = getattr(cm, "status", None) not in ("left", "kicked", None)
+        record_channel_membership(user_id, joined)
+        return joined
+
+    try:
+        return await _coalesced(_member_lookups, int(user_id), fetch)
+    except Exception as e:
+        logger.info("is_member_of_channel check failed for user %s: %s", user_id, e)
+        return False
+
+class AsyncBulkWriter(main.BulkWriter):
+    """main.BulkWriter with an awaitable `insert_many`, flushed by `run()` on the event loop.
+
+    Same buffer bound, size trigger and retry-then-drop policy as the threaded writer.
+    """
+
+    def __init__(self, table, insert_many, flush_size, flush_interval, max_pending):
+        super().__init__(table, insert_many, flush_size, flush_interval, max_pending)
+        self._flush_lock = asyncio.Lock()
+
+    def _schedule(self):
+        self._due = None  # asyncio.Event set once flush_size rows are pending, created by run()
+
+    def _flush_soon(self):
+        if self._due is not None:
+            self._due.set()
+
+    async def flush(self):
+        """Insert everything pending now. Returns the number of rows written."""
+        async with self._flush_lock:
+            rows = self._take()
+            if not rows:
+                return 0
+            try:
+                await self.insert_many(rows)
+            except Exception as e:
+                return self._flushed(rows, e)
+            return self._flushed(rows)
+
+    async def run(self):
+        self._due = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._due.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._due.clear()
+            await self.flush()
+
+
+async def _insert_messages(rows):
+    await messages_repo.insert_many(rows)
+
+MESSAGE_WRITER = AsyncBulkWriter("messages", _insert_messages, MESSAGE_FLUSH_SIZE, MESSAGE_FLUSH_INTERVAL, MESSAGE_BUFFER_MAX)
+
+def save_message(user_id, chat_id, message_id):
+    """Buffered like main.save_message; written by MESSAGE_WRITER."""
+    MESSAGE_WRITER.add({"user_id": user_id, "chat_id": chat_id, "message_id": message_id})
+
+async def premium_user_count():
+    count = COUNTERS.get("premium_users")
+    if count is not None:
+        return count
+    try:
+        count = await users_repo.count_premium()
+    except Exception as e:
+        logger.warning("Premium user count failed: %s", e)
+        return None
+    if count is not None:
+        COUNTERS.set("premium_users", count)
+    return count
+
+async def fetch_premium_page(after_id=None, before_id=None):
+    if before_id is not None:
+        rows = await users_repo.list_premium(before_id=before_id, limit=PREMIUM_PAGE_SIZE + 1)
+        return list(reversed(rows[:PREMIUM_PAGE_SIZE])), len(rows) > PREMIUM_PAGE_SIZE, True
+    rows = await users_repo.list_premium(after_id=after_id, limit=PREMIUM_PAGE_SIZE + 1)
+    return rows[:PREMIUM_PAGE_SIZE], after_id is not None, len(rows) > PREMIUM_PAGE_SIZE
+
+def _log_admin_send_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Admin notification failed: %s", future.exception())
+
+def _send_to_admins(text):
+    futures = []
+    for aid in ADMIN_IDS:
+        future = outbox.submit("send_message", aid, text, priority=PRIORITY_ADMIN, disable_web_page_preview=True)
+        future.add_done_callback(_log_admin_send_failure)
+        futures.append(future)
+    return futures
+
+def flush_admin_digest():
+    futures = []
+    for text in main.take_admin_digest():
+        futures += _send_to_admins(text)
+    return futures
+
+def notify_admins(text):
+    """Same digest as main.notify_admins, with the window timed on the event loop."""
+    if not ADMIN_IDS:
+        return
+    if ADMIN_DIGEST_WINDOW <= 0:
+        _send_to_admins(text)
+        return
+    if main.queue_admin_digest(text):
+        asyncio.get_running_loop().call_later(ADMIN_DIGEST_WINDOW, flush_admin_digest)
+
+# -------------------------
+# Handlers
+# -------------------------
+async def _send_courses(cid, user):
+    sent = await outbox.send_message(cid, current_catalog().overview_message, parse_mode="Markdown")
+    sent2 = await outbox.send_message(cid, PROMO_MESSAGE, parse_mode="Markdown", reply_markup=BUY_MARKUP)
+    if user:
+        save_message(user.id, cid, sent.message_id)
+        save_message(user.id, cid, sent2.message_id)
+
+@bot.message_handler(commands=["start"])
+async def send_welcome(message):
+    cid = message.chat.id
+    user = await find_or_create_user(
+        message.from_user.id,
+        message.from_user.username,
+        message.from_user.first_name,
+        message.from_user.last_name
+    )
+    if user and user.is_premium:
+        await outbox.send_message(cid, "🎉 Welcome back Premium User!", reply_markup=current_catalog().main_menu_markup)
+        return
+    if await is_member_of_channel(message.from_user.id):
+        await _send_courses(cid, user)
+        return
+    sent = await outbox.send_message(cid, JOIN_PROMPT, parse_mode="Markdown", reply_markup=JOIN_MARKUP)
+    if user:
+        save_message(user.id, cid, sent.message_id)
+
+@bot.callback_query_handler(func=lambda c: c.data == "buy")
+async def handle_buy(call):
+    try:
+        await bot.answer_callback_query(call.id, "Preparing payment…")
+    except Exception:
+        pass
+    cid = call.message.chat.id
+    try:
+        sent = await outbox.send_photo(
+            cid,
+            QR_IMAGE_URL + datetime.utcnow().strftime("%H%M%S"),
+            caption=QR_CAPTION,
+            parse_mode="Markdown",
+            reply_markup=PAID_MARKUP
+        )
+        user = await get_user_cached(call.from_user.id)
+        if user:
+            save_message(user.id, cid, sent.message_id)
+    except Exception as e:
+        logger.exception("handle_buy error: %s", e)
+        try:
+            await outbox.send_message(cid, "❌ Failed to send QR image. Please try again.")
+        except Exception:
+            pass
+
+@bot.callback_query_handler(func=lambda c: c.data == "i_paid")
+async def handle_paid(call):
+    try:
+        await bot.answer_callback_query(call.id, "Upload screenshot now")
+    except Exception:
+        pass
+    cid = call.message.chat.id
+    try:
+        await users_repo.set_pending_upload(call.from_user.id, True)
+    except Exception:
+        pass
+    sent = await outbox.send_message(cid, UPLOAD_PROMPT)
+    user = await get_user_cached(call.from_user.id)
+    if user:
+        save_message(user.id, cid, sent.message_id)
+
+@bot.callback_query_handler(func=lambda c: c.data == "check_join")
+async def handle_check_join(call):
+    try:
+        await bot.answer_callback_query(call.id)
+    except Exception:
+        pass
+    cid = call.message.chat.id
+    if await is_member_of_channel(call.from_user.id):
+        try:
+            await _send_courses(cid, await get_user_cached(call.from_user.id))
+        except Exception as e:
+            logger.exception("Error sending courses after successful join: %s", e)
+        return
+    try:
+        await outbox.send_message(cid, JOIN_REMINDER, parse_mode="Markdown", reply_markup=JOIN_MARKUP)
+    except Exception:
+        pass
+
+@bot.chat_member_handler()
+async def handle_channel_member_update(update):
+    if _is_join_channel(update.chat):
+        member = update.new_chat_member
+        record_channel_membership(member.user.id, member.status not in ("left", "kicked"), broadcast=True)
+
+async def _payment_exists(user_id, column, value):
+    if not value:
+        return False
+    if PAYMENT_DEDUP_INDEX.get((user_id, column, value)):
+        return True
+    try:
+        found = await payments_repo.exists(user_id, column, value)
+    except Exception as e:
+        logger.warning("Duplicate check on payments.%s failed: %s", column, e)
+        return False
+    if found:
+        PAYMENT_DEDUP_INDEX.set((user_id, column, value), True)
+    return found
+
+@bot.message_handler(content_types=["photo", "document"])
+async def handle_upload(message):
+    user = message.from_user
+    urow = replica_get_user(user.id)
+    if not urow or not urow.pending_upload:
+        try:
+            urow = await users_repo.get_by_telegram_id(int(user.id))
+        except Exception:
+            urow = None
+    if not urow or not urow.pending_upload:
+        await outbox.reply_to(message, UPLOAD_NOT_REQUESTED, parse_mode="Markdown")
+        return
+
+    if message.content_type == "photo":
+        media, content_type = message.photo[-1], "image/jpeg"
+    else:
+        media, content_type = message.document, message.document.mime_type or "application/octet-stream"
+    if (media.file_size or 0) > MAX_UPLOAD_BYTES:
+        await outbox.reply_to(message, UPLOAD_TOO_LARGE)
+        return
+
+    duplicate = await _payment_exists(urow.id, "file_unique_id", media.file_unique_id)
+    timings = {}
+    if not duplicate:
+        try:
+            t = time.monotonic()
+            file_info = await bot.get_file(media.file_id)
+            file_bytes = await bot.download_file(file_info.file_path)
+            timings["download"] = time.monotonic() - t
+        except Exception:
+            await outbox.reply_to(message, "❌ Failed to download your screenshot. Please try again.")
+            return
+        content_hash = hashlib.sha256(file_bytes).hexdigest()
+        duplicate = await _payment_exists(urow.id, "content_hash", content_hash)
+
+    if not duplicate:
+        ts = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        ext = os.path.splitext(file_info.file_path)[1] or ".jpg"
+        object_path = f"{UPLOAD_FOLDER_PREFIX}/{user.id}_{ts}{ext}"
+        try:
+            t = time.monotonic()
+            storage = supabase.storage.from_(BUCKET_NAME)
+            await storage.upload(object_path, file_bytes, {"content-type": content_type, "upsert": "true"})
+            url = await storage.get_public_url(object_path)
+            timings["upload"] = time.monotonic() - t
+        except Exception as e:
+            await outbox.reply_to(message, f"❌ Upload failed. Error: {e}")
+            return
+        try:
+            t = time.monotonic()
+            await payments_repo.create(urow.id, user.username or "", object_path, url, content_hash, media.file_unique_id)
+            timings["db_insert"] = time.monotonic() - t
+            remember_payment(urow.id, media.file_unique_id, content_hash)
+        except Exception:
+            await outbox.reply_to(message, "❌ Failed to record your payment. Please try again.")
+            return
+        logger.info(
+            "Upload for user %s: download=%.3fs upload=%.3fs db_insert=%.3fs",
+            user.id, timings["download"], timings["upload"], timings["db_insert"],
+        )
+
+    try:
+        await users_repo.set_pending_upload(user.id, False)
+    except Exception:
+        pass
+    if duplicate:
+        await outbox.reply_to(message, UPLOAD_DUPLICATE)
+        return
+    await outbox.send_message(message.chat.id, UPLOAD_RECEIVED, parse_mode="Markdown")
+    notify_admins(payment_notice(user, urow.id, url))
+
+@bot.message_handler(commands=["admin"])
+async def admin_help(message):
+    if not is_admin(message.from_user.id):
+        return
+    await outbox.reply_to(message, ADMIN_HELP, parse_mode="Markdown")
+
+async def _send_profile(chat_id, seconds):
+    """Runs as its own task, so it logs its own failures."""
+    try:
+        # the sampler sleeps between samples: run it off the loop, which it then samples too
+        folded = await asyncio.to_thread(PROFILER.run, seconds)
+    except RuntimeError as e:
+        await outbox.send_message(chat_id, f"❌ {e}")
+        return
+    try:
+        dump, caption = profile_document(folded, seconds)
+        await outbox.send_document(chat_id, dump, caption=caption, priority=PRIORITY_ADMIN)
+    except Exception as e:
+        logger.warning("Sending profile failed: %s", e)
+
+@bot.message_handler(commands=["profile"])
+async def admin_profile(message):
+    if not is_admin(message.from_user.id):
+        return
+    seconds = profile_seconds(message.text)
+    if seconds is None:
+        await outbox.reply_to(message, "Usage: /profile [seconds]")
+        return
+    await outbox.reply_to(message, f"⏱ Profiling for {seconds:g}s…")
+    _spawn(_send_profile(message.chat.id, seconds))
+
+@bot.message_handler(commands=["trace"])
+async def admin_trace(message):
+    if not is_admin(message.from_user.id):
+        return
+    await outbox.reply_to(message, trace_command(message.text))
+
+@bot.message_handler(commands=["allpremiumuser"])
+async def admin_allpremiumuser(message):
+    if not is_admin(message.from_user.id):
+        await outbox.reply_to(message, "❌ You are not an admin.")
+        return
+    try:
+        rows, has_prev, has_next = await fetch_premium_page()
+    except Exception as e:
+        logger.exception("Supabase query failed in /allpremiumuser: %s", e)
+        await outbox.reply_to(message, "❌ Database error while fetching premium users (see logs).")
+        return
+    if not rows:
+        await outbox.reply_to(message, "❌ No Premium users found.")
+        return
+    text, markup = render_premium_page(rows, has_prev, has_next, await premium_user_count())
+    try:
+        await outbox.reply_to(message, text, parse_mode="Markdown", reply_markup=markup)
+    except Exception:
+        await outbox.reply_to(message, text, reply_markup=markup)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith("prem:"))
+async def handle_premium_page(call):
+    if not is_admin(call.from_user.id):
+        return
+    try:
+        await bot.answer_callback_query(call.id)
+    except Exception:
+        pass
+    _, direction, anchor = call.data.split(":")
+    if direction == "n":
+        rows, has_prev, has_next = await fetch_premium_page(after_id=int(anchor))
+    else:
+        rows, has_prev, has_next = await fetch_premium_page(before_id=int(anchor))
+    if not rows:
+        return
+    text, markup = render_premium_page(rows, has_prev, has_next, await premium_user_count())
+    edit = dict(chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=markup)
+    try:
+        await outbox.call("edit_message_text", text, parse_mode="Markdown", **edit)
+    except Exception:
+        await outbox.call("edit_message_text", text, **edit)
+
+async def _delete_chat_messages(chat_id, message_ids):
+    """Async twin of main._delete_chat_messages: bulk deletes, one by one for a batch that fails."""
+    removed = []
+    for i in range(0, len(message_ids), MESSAGE_DELETE_BATCH):
+        batch = message_ids[i:i + MESSAGE_DELETE_BATCH]
+        try:
+            await outbox.call("delete_messages", chat_id, batch, priority=PRIORITY_BULK)
+            removed.extend(batch)
+            continue
+        except Exception as e:
+            logger.info("Bulk delete failed in chat %s, deleting one by one: %s", chat_id, e)
+        for mid in batch:
+            try:
+                await outbox.call("delete_message", chat_id, mid, priority=PRIORITY_BULK)
+                removed.append(mid)
+            except Exception as e:
+                logger.info("Could not delete message %s in chat %s: %s", mid, chat_id, e)
+    return removed
+
+async def delete_old_messages(user_row, keep_message_ids=()):
+    """Async twin of main.delete_old_messages; runs as its own task, so it logs its own failures."""
+    try:
+        await MESSAGE_WRITER.flush()
+        by_chat = group_messages_by_chat(await messages_repo.list_for_user(user_row.id), keep_message_ids)
+        for chat_id, message_ids in by_chat.items():
+            removed = await _delete_chat_messages(chat_id, message_ids)
+            for i in range(0, len(removed), MESSAGE_ROWS_DELETE_CHUNK):
+                await messages_repo.delete(user_row.id, chat_id, removed[i:i + MESSAGE_ROWS_DELETE_CHUNK])
+    except Exception as e:
+        logger.warning("Message cleanup failed for user %s: %s", user_row.id, e)
+
+@bot.message_handler(commands=["upgrade"])
+async def admin_upgrade(message):
+    if not is_admin(message.from_user.id):
+        return
+    args = message.text.split()
+    if len(args) < 2:
+        await outbox.reply_to(message, "Usage: /upgrade <user_id|username>")
+        return
+    target = args[1]
+    try:
+        if target.isdigit():
+            user_row = await users_repo.get_by_id(int(target))
+        else:
+            user_row = await users_repo.get_by_username(target.lstrip("@"))
+    except Exception:
+        await outbox.reply_to(message, "❌ Database error while searching for user.")
+        return
+    if not user_row:
+        await outbox.reply_to(message, f"❌ User {target} not found.")
+        return
+    if user_row.is_premium:
+        await outbox.reply_to(message, f"✅ User {target} is already Premium.")
+        return
+    try:
+        await users_repo.set_premium(user_row.id)
+        await payments_repo.mark_verified(user_row.id)
+    except Exception:
+        await outbox.reply_to(message, f"❌ Failed to upgrade {target}.")
+        return
+    main.invalidate_user_cache(user_row.telegram_id)
+    main.publish_invalidation("premium", user_row.telegram_id)
+    main.publish_invalidation("counter", "premium_users")
+
+    keep = set()
+    try:
+        sent = await outbox.send_message(user_row.telegram_id, UPGRADE_NOTICE, parse_mode="Markdown")
+        keep.add(sent.message_id)
+        save_message(user_row.id, user_row.telegram_id, sent.message_id)
+    except Exception:
+        pass
+    _spawn(delete_old_messages(user_row, keep))
+    await outbox.reply_to(message, f"✅ User {target} upgraded to Premium!")
+
+@bot.message_handler(func=lambda message: True)
+async def handle_menu(message):
+    premium = main.PREMIUM_INDEX.contains(message.from_user.id)
+    if premium is None:  # index not loaded yet
+        user_row = await get_user_cached(message.from_user.id)
+        premium = bool(user_row and user_row.is_premium)
+    if not premium:
+        return
+    reply_text, reply_markup = current_catalog().menu.get(message.text, COURSE_UNAVAILABLE_REPLY)
+    await outbox.send_message(message.chat.id, reply_text, reply_markup=reply_markup)
+
+main.instrument_handlers(bot)  # every handler is registered above this line
+
+# -------------------------
+# ASGI app (webhook)
+# -------------------------
+_in_flight = None  # asyncio.Semaphore, created on startup
+_tasks = set()
+
+async def _process(update):
+    async with _in_flight:
+        try:
+            main.maybe_trace(update)
+            await bot.process_new_updates([update])
+        except Exception as e:
+            main.UPDATE_DEDUP.forget(update.update_id)
+            logger.exception("Failed to process update: %s", e)
+
+def _spawn(coro):
+    task = asyncio.ensure_future(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+async def startup():
+    global supabase, users_repo, payments_repo, messages_repo, _in_flight
+    supabase = await acreate_client(main.SUPABASE_URL, main.SUPABASE_KEY)
+    users_repo = AsyncUsersRepository(supabase, replica=main.USER_REPLICA)
+    payments_repo = AsyncPaymentsRepository(supabase)
+    messages_repo = AsyncMessagesRepository(supabase)
+    _in_flight = asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+    main.start_background_work()  # scheduler jobs and the invalidation bus listener (threads)
+    _spawn(outbox.run())
+    _spawn(MESSAGE_WRITER.run())
+
+async def shutdown():
+    await MESSAGE_WRITER.flush()
+    pending = flush_admin_digest()
+    if pending:
+        await asyncio.wait(pending, timeout=ADMIN_FLUSH_TIMEOUT)
+    await bot.close_session()
+
+async def _respond(send, status, body=b"OK"):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+    await send({"type": "http.response.body", "body": body})
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    path, method = scope["path"], scope["method"]
+    if method == "GET" and path == "/":
+        await _respond(send, 200, b"Bot is running")
+    elif method == "GET" and path == "/metrics":
+        await _respond(send, 200, main.METRICS.render().encode())
+    elif method == "GET" and path == "/set_webhook":
+        await bot.remove_webhook()
+        full_url = f"{WEBHOOK_URL}/{BOT_TOKEN}"
+        await bot.set_webhook(
+            url=full_url,
+            drop_pending_updates=True,
+            allowed_updates=["message", "callback_query", "chat_member"],
+        )
+        await _respond(send, 200, f"Webhook set to {full_url}".encode())
+    elif method == "POST" and path == f"/{BOT_TOKEN}":
+        content_type = dict(scope["headers"]).get(b"content-type", b"")
+        if not content_type.startswith(b"application/json"):
+            await _respond(send, 403, b"Forbidden")
+            return
+        body = await _read_body(receive)
+        try:
+            update = types.Update.de_json(body.decode("utf-8"))
+        except Exception as e:
+            # log but return 200 so Telegram doesn't retry excessively
+            logger.exception("Failed to decode update: %s", e)
+        else:
+            if main.UPDATE_DEDUP.seen(update.update_id):
+                logger.info("Dropped redelivered update %s", update.update_id)
+            else:
+                # acknowledge right away; the handler runs as its own task
+                _spawn(_process(update))
+        await _respond(send, 200)
+    else:
+        await _respond(send, 404, b"Not Found")
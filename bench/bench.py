@@ -0,0 +1,515 @@
+"""
+Offline throughput benchmark for main.py.
+
+Starts one in-process HTTP server that stands in for both the Telegram Bot
+API and the Supabase PostgREST/storage endpoints, points main.py at it, and
+replays a synthetic mix of updates through the real webhook route (via the
+Flask test client). Nothing leaves the machine.
+
+    python bench/bench.py --updates 2000 --concurrency 16 \\
+        --mix start=40,buy=20,upload=10,menu=30 \\
+        --telegram-latency 40 --supabase-latency 15 --telegram-429 0.01
+
+Scenarios (each is a short per-user session; updates in a session run in order):
+    start   /start from a known or brand-new non-premium user
+    buy     "buy" then "i_paid" callbacks
+    upload  "i_paid" callback then a photo (download, storage upload, payment insert)
+    menu    a premium user pressing a course menu button
+
+Handlers run inline in the request (telebot's thread pool is switched off),
+so the latency of a webhook request is the full handler time, including
+outbox sends. Reports updates/s, p50/p99 latency and backend calls per
+update; --json prints the same numbers machine-readably for comparisons.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BOT_TOKEN = "123456:bench-token"
+USER_ID_BASE = 10_000_000
+
+# -------------------------
+# Fake Telegram + Supabase
+# -------------------------
+class FakeBackend:
+    """State, knobs and call counters shared by the fake endpoints."""
+
+    POSTGREST_PARAMS = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+
+    def __init__(self, telegram_latency=0.0, supabase_latency=0.0, telegram_429=0.0, retry_after=1, file_size=60_000):
+        self.telegram_latency = telegram_latency
+        self.supabase_latency = supabase_latency
+        self.telegram_429 = telegram_429
+        self.retry_after = retry_after
+        self.file_size = file_size
+        self.lock = threading.Lock()
+        self.tables = {"users": [], "payments": [], "messages": []}
+        self.ids = {name: itertools.count(1) for name in self.tables}
+        self.message_ids = itertools.count(1)
+        self.calls = Counter()  # (backend, op) -> requests served
+        self.injected_429 = 0
+
+    def seed_users(self, count, premium_ratio):
+        """Create `count` users; returns (normal telegram_ids, premium telegram_ids)."""
+        normal, premium = [], []
+        for i in range(count):
+            telegram_id = USER_ID_BASE + i
+            status = "premium" if i < count * premium_ratio else "normal"
+            self.tables["users"].append(self._user_defaults({
+                "telegram_id": telegram_id, "username": f"user{telegram_id}", "first_name": f"user{telegram_id}",
+                "status": status,
+            }))
+            (premium if status == "premium" else normal).append(telegram_id)
+        return normal, premium
+
+    def _user_defaults(self, row):
+        now = datetime.utcnow().isoformat()
+        return dict({"id": next(self.ids["users"]), "status": "normal", "pending_upload": False,
+                     "last_name": None, "created_at": now, "updated_at": now}, **row)
+
+    # ---- Telegram Bot API ----
+    def telegram(self, method, params):
+        time.sleep(self.telegram_latency)
+        with self.lock:
+            self.calls["telegram", method] += 1
+            if method != "file_download" and self.telegram_429 and random.random() < self.telegram_429:
+                self.injected_429 += 1
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {self.retry_after}",
+                             "parameters": {"retry_after": self.retry_after}}
+        chat_id = _int(params.get("chat_id"), 0)
+        if method in ("sendMessage", "sendPhoto", "sendDocument", "editMessageText"):
+            result = {"message_id": next(self.message_ids), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        elif method == "getChatMember":
+            user_id = _int(params.get("user_id"), 0)
+            result = {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "member"}}
+        elif method == "getFile":
+            file_id = params.get("file_id", "file")
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": self.file_size,
+                      "file_path": f"photos/{file_id}.jpg"}
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+    def file_bytes(self, file_path):
+        """Deterministic per-file content, so content-hash dedup sees distinct screenshots."""
+        time.sleep(self.telegram_latency)
+        with self.lock:
+            self.calls["telegram", "file_download"] += 1
+        seed = file_path.encode()
+        return (seed * (self.file_size // len(seed) + 1))[:self.file_size]
+
+    # ---- Supabase PostgREST / storage ----
+    def storage(self, path, body):
+        time.sleep(self.supabase_latency)
+        with self.lock:
+            self.calls["supabase", "storage upload"] += 1
+        return 200, {"Key": path.split("/object/", 1)[-1]}, {}
+
+    def rest(self, method, table, query, body, prefer):
+        time.sleep(self.supabase_latency)
+        with self.lock:
+            self.calls["supabase", f"{method} {table}"] += 1
+            rows = self.tables.setdefault(table, [])
+            self.ids.setdefault(table, itertools.count(1))
+            filters = [(col, values[-1]) for col, values in query.items() if col not in self.POSTGREST_PARAMS]
+            matched = [r for r in rows if all(_match(r, col, spec) for col, spec in filters)]
+            headers = {}
+            if method == "GET":
+                total = len(matched)
+                result = _order(matched, query.get("order", [""])[-1])
+                if "limit" in query:
+                    result = result[:int(query["limit"][-1])]
+                if "count=exact" in prefer:
+                    headers["Content-Range"] = f"0-{max(len(result) - 1, 0)}/{total}"
+                return 200, _project(result, query.get("select", ["*"])[-1]), headers
+            if method == "POST":
+                payload = body if isinstance(body, list) else [body]
+                conflict = query.get("on_conflict", [None])[-1] if "merge-duplicates" in prefer else None
+                written = []
+                for item in payload:
+                    existing = next((r for r in rows if conflict and r.get(conflict) == item.get(conflict)), None)
+                    if existing is not None:
+                        existing.update(item)
+                        written.append(existing)
+                        continue
+                    row = self._user_defaults(item) if table == "users" else dict({"id": next(self.ids[table])}, **item)
+                    rows.append(row)
+                    written.append(row)
+                return 201, [dict(r) for r in written], headers
+            if method == "PATCH":
+                for r in matched:
+                    r.update(body)
+                return 200, [dict(r) for r in matched], headers
+            if method == "DELETE":
+                doomed = {id(r) for r in matched}
+                self.tables[table] = [r for r in rows if id(r) not in doomed]
+                return 200, [dict(r) for r in matched], headers
+        return 405, {"message": "method not allowed"}, {}
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.calls)
+
+
+def _int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def _text(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return "null" if value is None else str(value)
+
+def _match(row, column, spec):
+    op, _, arg = spec.partition(".")
+    value = row.get(column)
+    if op == "eq":
+        return _text(value) == arg
+    if op == "neq":
+        return _text(value) != arg
+    if op == "is":
+        return _text(value) == arg
+    if op == "in":
+        return _text(value) in [a.strip('"') for a in arg.strip("()").split(",")]
+    if op in ("like", "ilike"):
+        pattern = re.escape(arg).replace("\\*", ".*").replace("%", ".*")
+        return re.fullmatch(pattern, _text(value), re.IGNORECASE if op == "ilike" else 0) is not None
+    if value is None:
+        return False
+    other = type(value)(arg) if isinstance(value, (int, float)) and not isinstance(value, bool) else arg
+    return {"gt": value > other, "gte": value >= other, "lt": value < other, "lte": value <= other}.get(op, False)
+
+def _order(rows, spec):
+    result = list(rows)
+    for part in reversed([p for p in spec.split(",") if p]):
+        column, _, direction = part.partition(".")
+        result.sort(key=lambda r: (r.get(column) is None, r.get(column) or 0), reverse=direction.startswith("desc"))
+    return result
+
+def _project(rows, select):
+    if select in ("", "*"):
+        return [dict(r) for r in rows]
+    columns = [c.strip() for c in select.split(",")]
+    return [{c: r.get(c) for c in columns} for r in rows]
+
+def _form_params(content_type, body):
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return {k: v[-1] for k, v in parse_qs(body.decode("utf-8", "replace")).items()}
+    if content_type.startswith("multipart/form-data"):
+        text = body.decode("utf-8", "replace")
+        return dict(re.findall(r'name="([^"]+)"\r\n\r\n([^\r]*)\r\n', text))
+    if content_type.startswith("application/json") and body:
+        return json.loads(body)
+    return {}
+
+
+def make_handler(backend):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real endpoints
+        # headers and body go out in separate writes; with Nagle on, delayed ACKs add ~40ms per call
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _body(self):
+            if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().strip().split(b";")[0], 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        return b"".join(chunks)
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def _send(self, status, payload, headers=None, content_type="application/json"):
+            data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _dispatch(self, method):
+            url = urlsplit(self.path)
+            path = unquote(url.path)
+            body = self._body()
+            content_type = self.headers.get("Content-Type", "")
+            if path.startswith("/file/bot"):
+                self._send(200, backend.file_bytes(path.split("/", 3)[-1]), content_type="image/jpeg")
+            elif path.startswith("/bot"):
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                params.update(_form_params(content_type, body))
+                self._send(*backend.telegram(path.rsplit("/", 1)[-1], params))
+            elif path.startswith("/storage/v1/object/"):
+                self._send(*backend.storage(path, body))
+            elif path.startswith("/rest/v1/"):
+                payload = json.loads(body) if body else {}
+                status, result, headers = backend.rest(
+                    method, path.split("/")[3], parse_qs(url.query, keep_blank_values=True), payload,
+                    self.headers.get("Prefer", ""),
+                )
+                self._send(status, result, headers)
+            else:
+                self._send(404, {"message": "not found"})
+
+        def do_GET(self):
+            self._dispatch("GET")
+
+        def do_POST(self):
+            self._dispatch("POST")
+
+        def do_PATCH(self):
+            self._dispatch("PATCH")
+
+        def do_DELETE(self):
+            self._dispatch("DELETE")
+
+    return Handler
+
+
+def start_fake_server(backend):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(backend))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-backend", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# -------------------------
+# Point main.py at the fakes
+# -------------------------
+def load_bot(base_url, args):
+    """Configure the environment for the fakes, then import main.py."""
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "WEBHOOK_URL": "http://bench.invalid",
+        "SUPABASE_URL": base_url,
+        "SUPABASE_KEY": "bench.bench.bench",
+        "ADMIN_TELEGRAM_IDS": "1",
+        "WEBHOOK_QUEUE_ENABLED": "0",
+        "SEND_GLOBAL_RATE": str(args.send_rate),
+        "SEND_CHAT_RATE": str(args.send_rate),
+        "SEND_CHAT_BURST": str(max(3, int(args.send_rate))),
+    })
+    import telebot
+    telebot.apihelper.API_URL = base_url + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = base_url + "/file/bot{0}/{1}"
+    import main
+    main.bot.threaded = False  # run handlers inside the webhook request so its latency is the handler's
+    return main
+
+# -------------------------
+# Synthetic updates
+# -------------------------
+class UpdateFactory:
+    def __init__(self, normal_ids, premium_ids, menu_buttons, new_user_ratio):
+        self.normal_ids = normal_ids
+        self.premium_ids = premium_ids
+        self.menu_buttons = menu_buttons
+        self.new_user_ratio = new_user_ratio
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_user_ids = itertools.count(USER_ID_BASE * 2)
+        self._files = itertools.count(1)
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"user{uid}"}
+
+    def _message(self, uid, **fields):
+        return dict({"message_id": next(self._message_ids), "date": int(time.time()),
+                     "chat": {"id": uid, "type": "private"}, "from": self._user(uid)}, **fields)
+
+    def _update(self, **fields):
+        return dict({"update_id": next(self._update_ids)}, **fields)
+
+    def _callback(self, uid, data):
+        return self._update(callback_query={
+            "id": str(next(self._message_ids)), "from": self._user(uid), "chat_instance": "bench",
+            "data": data, "message": self._message(uid, text="bench"),
+        })
+
+    def session(self, kind):
+        if kind == "start":
+            new = not self.normal_ids or random.random() < self.new_user_ratio
+            uid = next(self._new_user_ids) if new else random.choice(self.normal_ids)
+            return [self._update(message=self._message(uid, text="/start"))]
+        if kind == "buy":
+            uid = random.choice(self.normal_ids)
+            return [self._callback(uid, "buy"), self._callback(uid, "i_paid")]
+        if kind == "upload":
+            uid = random.choice(self.normal_ids)
+            file_id = f"bench-file-{next(self._files)}"
+            photo = [{"file_id": file_id, "file_unique_id": file_id, "width": 1080, "height": 1920,
+                      "file_size": 60_000}]
+            return [self._callback(uid, "i_paid"), self._update(message=self._message(uid, photo=photo))]
+        if kind == "menu":
+            uid = random.choice(self.premium_ids)
+            return [self._update(message=self._message(uid, text=random.choice(self.menu_buttons)))]
+        raise ValueError(f"unknown scenario {kind!r}")
+
+# -------------------------
+# Runner and report
+# -------------------------
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def run(main, factory, mix, total_updates, concurrency):
+    """Replay sessions until `total_updates` updates were posted; returns (elapsed, [(kind, seconds, status)])."""
+    kinds, weights = zip(*mix.items())
+    sessions = []
+    planned = 0
+    while planned < total_updates:
+        kind = random.choices(kinds, weights)[0]
+        session = factory.session(kind)
+        sessions.append((kind, session))
+        planned += len(session)
+    pending = iter(sessions)
+    pending_lock = threading.Lock()
+    results = []
+    results_lock = threading.Lock()
+    url = f"/{main.BOT_TOKEN}"
+
+    def worker():
+        client = main.app.test_client()
+        local = []
+        while True:
+            with pending_lock:
+                item = next(pending, None)
+            if item is None:
+                break
+            kind, updates = item
+            for update in updates:
+                start = time.perf_counter()
+                response = client.post(url, data=json.dumps(update), content_type="application/json")
+                local.append((kind, time.perf_counter() - start, response.status_code))
+        with results_lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=worker, name=f"bench-{i}") for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, results
+
+def summarize(elapsed, results, calls, injected_429):
+    latencies = [r[1] for r in results]
+    count = len(results)
+    report = {
+        "updates": count,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(count / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p90": round(percentile(latencies, 90) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(max(latencies, default=0.0) * 1000, 2),
+        },
+        "non_200": sum(1 for r in results if r[2] != 200),
+        "scenarios": {},
+        "backend_calls_per_update": {},
+        "calls_per_update": {},
+        "telegram_429_injected": injected_429,
+    }
+    for kind in sorted({r[0] for r in results}):
+        values = [r[1] for r in results if r[0] == kind]
+        report["scenarios"][kind] = {
+            "updates": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+        }
+    per_backend = Counter()
+    for (backend, op), n in calls.items():
+        per_backend[backend] += n
+        report["calls_per_update"][f"{backend} {op}"] = round(n / count, 3) if count else 0.0
+    report["backend_calls_per_update"] = {b: round(n / count, 3) if count else 0.0 for b, n in per_backend.items()}
+    return report
+
+def print_report(report):
+    lat = report["latency_ms"]
+    print(f"updates: {report['updates']} in {report['seconds']}s -> {report['updates_per_second']} updates/s"
+          f" ({report['non_200']} non-200)")
+    print(f"latency ms: p50 {lat['p50']}  p90 {lat['p90']}  p99 {lat['p99']}  max {lat['max']}")
+    for kind, s in report["scenarios"].items():
+        print(f"  {kind:<8} n={s['updates']:<6} p50 {s['p50_ms']}ms  p99 {s['p99_ms']}ms")
+    print("backend calls per update: " + ", ".join(f"{b} {n}" for b, n in report["backend_calls_per_update"].items()))
+    for name, n in sorted(report["calls_per_update"].items(), key=lambda kv: -kv[1]):
+        print(f"  {name:<32} {n}")
+    print(f"telegram 429s injected: {report['telegram_429_injected']}")
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--updates", type=int, default=1000, help="updates to replay (after warmup)")
+    parser.add_argument("--warmup", type=int, default=50, help="updates replayed before measuring")
+    parser.add_argument("--concurrency", type=int, default=8, help="parallel webhook clients")
+    parser.add_argument("--mix", default="start=40,buy=20,upload=10,menu=30", help="scenario weights")
+    parser.add_argument("--users", type=int, default=1000, help="users seeded in the fake users table")
+    parser.add_argument("--premium-ratio", type=float, default=0.3)
+    parser.add_argument("--new-user-ratio", type=float, default=0.2, help="share of /start from unseen users")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="ms added to each Bot API call")
+    parser.add_argument("--supabase-latency", type=float, default=0.0, help="ms added to each Supabase call")
+    parser.add_argument("--telegram-429", type=float, default=0.0, help="probability a Bot API call gets a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after sent with injected 429s")
+    parser.add_argument("--send-rate", type=float, default=1000.0,
+                        help="outbox rate limits (global and per chat); use 28 to model production limits")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    backend = FakeBackend(args.telegram_latency / 1000, args.supabase_latency / 1000,
+                          args.telegram_429, args.retry_after)
+    normal_ids, premium_ids = backend.seed_users(args.users, args.premium_ratio)
+    server, base_url = start_fake_server(backend)
+    main = load_bot(base_url, args)
+    factory = UpdateFactory(normal_ids, premium_ids, list(main.current_catalog().menu), args.new_user_ratio)
+    mix = parse_mix(args.mix)
+
+    if args.warmup:
+        run(main, factory, mix, args.warmup, args.concurrency)
+        main.MESSAGE_WRITER.flush()
+    before, injected_before = backend.snapshot(), backend.injected_429
+    elapsed, results = run(main, factory, mix, args.updates, args.concurrency)
+    main.MESSAGE_WRITER.flush()
+    calls = backend.snapshot() - before
+    report = summarize(elapsed, results, calls, backend.injected_429 - injected_before)
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main_cli()
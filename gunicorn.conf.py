@@ -0,0 +1,6 @@
+# Loaded automatically by gunicorn from the working directory.
+
+def post_worker_init(worker):
+    # background jobs run in each worker, never in a --preload master
+    import main
+    main.start_background_work()
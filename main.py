@@ -1,15 +1,39 @@
 import os
+import json
+import atexit
+import bisect
+import contextvars
+import fcntl
+import functools
+import heapq
+import hashlib
+import hmac
+import io
+import itertools
+import tempfile
+import queue
+import socket
+import sqlite3
 import logging
 import threading
 import time
 import random
+import re
+import sys
+import inspect
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from collections import Counter, OrderedDict, deque
+from urllib.parse import urlsplit
+from concurrent.futures import Future, wait
 from datetime import datetime
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify
 import telebot
 from telebot import types
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 from dotenv import load_dotenv
+from repository import UserRow, UserReplica, UsersRepository, PaymentsRepository, MessagesRepository
 
 # -------------------------
 # Load environment
@@ -38,14 +62,807 @@ for part in (_ADMIN_TELEGRAM_IDS_RAW or "").split(","):
 
 UPLOAD_FOLDER_PREFIX = os.getenv("UPLOAD_FOLDER_PREFIX", "payments")
 
+
+def _env_flag(name, default=False):
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    return raw.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Webhook ingestion: when enabled the webhook route only validates and enqueues
+# updates, and a pool of worker threads runs the handlers.
+WEBHOOK_QUEUE_ENABLED = _env_flag("WEBHOOK_QUEUE_ENABLED")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "20"))
+
+# Connection pools: sized to the number of threads that can talk to each
+# backend at once (bot/webhook workers + outbox senders), so nobody waits for
+# a socket or pays a fresh TLS handshake under load.
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "32"))
+SUPABASE_POOL_SIZE = int(os.getenv("SUPABASE_POOL_SIZE", "24"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))  # seconds an idle connection is kept
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+
+# Directory for the cross-worker cache invalidation bus (one Unix socket per
+# gunicorn worker). Empty disables it; caches are then per-process only.
+CACHE_BUS_DIR = os.getenv("CACHE_BUS_DIR", "")
+
+# Periodic/delayed jobs; single-instance jobs take a flock in this directory so one worker runs them.
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "2"))
+SCHEDULER_LOCK_DIR = os.getenv("SCHEDULER_LOCK_DIR", "")
+
+# Optional local SQLite mirror of the users table (path to the db file).
+USER_REPLICA_PATH = os.getenv("USER_REPLICA_PATH", "")
+USER_REPLICA_SYNC_INTERVAL = float(os.getenv("USER_REPLICA_SYNC_INTERVAL", "60"))  # seconds
+
+# In-memory set of premium telegram_ids (full load at startup, then deltas by updated_at).
+PREMIUM_INDEX_SYNC_INTERVAL = float(os.getenv("PREMIUM_INDEX_SYNC_INTERVAL", "60"))  # seconds
+PREMIUM_INDEX_RELOAD_INTERVAL = float(os.getenv("PREMIUM_INDEX_RELOAD_INTERVAL", "3600"))  # seconds between full reloads
+
+# Recently seen update_ids, so Telegram redeliveries are dropped before any handler runs.
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))
+UPDATE_DEDUP_PATH = os.getenv("UPDATE_DEDUP_PATH", "")  # optional sqlite file: survives restarts, shared by workers
+UPDATE_DEDUP_RETENTION = float(os.getenv("UPDATE_DEDUP_RETENTION", "86400"))  # Telegram keeps updates 24h
+
+# Diagnostics: /debug/* routes need this token (disabled when unset); admins also get /profile and /trace.
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))  # fraction of updates traced
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "200"))  # most recent traces kept in memory
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "120"))
+# /debug/profile holds its worker for the whole run: stay under gunicorn's --timeout (30s by default)
+PROFILE_HTTP_MAX_SECONDS = float(os.getenv("PROFILE_HTTP_MAX_SECONDS", "20"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))  # seconds between stack samples
+
 # -------------------------
 # Setup
 # -------------------------
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-bot = telebot.TeleBot(BOT_TOKEN, threaded=True, num_threads=20)
+
+# -------------------------
+# Metrics (Prometheus text format, served at /metrics)
+# -------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# the handler an update is being processed by; copied into outbox jobs, so sends are attributed too
+CURRENT_HANDLER = contextvars.ContextVar("current_handler", default="none")
+
+def _prom_labels(labels):
+    def esc(v):
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{k}="{esc(v)}"' for k, v in labels)
+
+class Metrics:
+    """Thread-safe latency histograms and counters, rendered in Prometheus text format.
+
+    Point-in-time values (cache sizes, queue depths) come from collectors
+    registered with add_collector(), each yielding (name, type, labels, value).
+    Samples are grouped per metric name on render, since the text format
+    requires each family's lines to be contiguous.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, labels) -> per-bucket counts (+Inf last), then the sum
+        self._counters = {}  # (name, labels) -> value
+        self._collectors = []
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            hist[i] += 1
+            hist[-1] += seconds
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def error(self, site):
+        self.inc("bot_errors_total", site=site, handler=CURRENT_HANDLER.get())
+
+    def add_collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        with self._lock:
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+            counters = dict(self._counters)
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), hist in sorted(histograms.items()):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), hist):
+                cumulative += count
+                lines.append(f"{name}_bucket{{{_prom_labels(labels + (('le', bound),))}}} {cumulative}")
+            lines.append(f"{name}_sum{{{_prom_labels(labels)}}} {hist[-1]}")
+            lines.append(f"{name}_count{{{_prom_labels(labels)}}} {cumulative}")
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, "counter")
+            lines.append(f"{name}{{{_prom_labels(labels)}}} {value}")
+        families = {}  # name -> (type, sample lines), in first-seen order
+        for collector in self._collectors:
+            try:
+                samples = list(collector())
+            except Exception as e:
+                logger.warning("Metrics collector %s failed: %s", collector.__name__, e)
+                continue
+            for name, kind, labels, value in samples:
+                family = families.setdefault(name, (kind, []))
+                family[1].append(f"{name}{{{_prom_labels(sorted(labels.items()))}}} {value}")
+        for name, (kind, samples) in families.items():
+            declare(name, kind)
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+# -------------------------
+# Profiling and tracing
+# -------------------------
+class SamplingProfiler:
+    """Samples every thread's stack via sys._current_frames() for a fixed time.
+
+    The result is in collapsed-stack format ("thread;outer;...;inner count"
+    per line), which flamegraph.pl and speedscope read directly. One profile
+    runs at a time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def run(self, seconds, interval=PROFILE_INTERVAL):
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("a profile is already running")
+        try:
+            stacks = Counter()
+            me = threading.get_ident()
+            deadline = time.monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+            while time.monotonic() < deadline:
+                # pool threads share a name prefix; fold them into one root
+                names = {t.ident: re.sub(r"[-_]\d+$", "", t.name) for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    labels = []
+                    while frame is not None:
+                        labels.append(self._frame_label(frame))
+                        frame = frame.f_back
+                    labels.append(names.get(ident, str(ident)))
+                    stacks[";".join(reversed(labels))] += 1
+                time.sleep(interval)
+            return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        finally:
+            self._lock.release()
+
+PROFILER = SamplingProfiler()
+
+# (trace, span) of the update being processed; copied into outbox jobs with the rest of the context
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    __slots__ = ("name", "start", "end", "children")
+
+    def __init__(self, name, start, end=None):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.children = []
+
+    def to_dict(self, origin):
+        children = [c.to_dict(origin) for c in self.children]
+        # the root (and any span still open) ends with its last child
+        end = self.end if self.end is not None else max([self.start] + [c["_end"] for c in children])
+        return {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 2),
+            "duration_ms": round((end - self.start) * 1000, 2),
+            "children": children,
+            "_end": end,
+        }
+
+class Trace:
+    """Span tree for one sampled update (handler -> helpers -> Supabase / Telegram calls)."""
+
+    def __init__(self, update_id):
+        self.update_id = update_id
+        self.started_at = time.time()
+        self.root = Span(f"update {update_id}", time.monotonic())
+        self._lock = threading.Lock()
+
+    def add(self, parent, name, start, end=None):
+        span = Span(name, start, end)
+        with self._lock:
+            parent.children.append(span)
+        return span
+
+    def to_dict(self):
+        with self._lock:
+            tree = self.root.to_dict(self.root.start)
+
+        def strip(node):
+            node.pop("_end", None)
+            for child in node["children"]:
+                strip(child)
+            return node
+
+        return {"update_id": self.update_id, "started_at": self.started_at, "root": strip(tree)}
+
+    def summary(self):
+        tree = self.to_dict()["root"]
+        handler = tree["children"][0]["name"] if tree["children"] else "-"
+        return {"update_id": self.update_id, "started_at": self.started_at, "handler": handler,
+                "duration_ms": tree["duration_ms"]}
+
+TRACES = OrderedDict()  # update_id -> Trace, most recent last
+_TRACES_LOCK = threading.Lock()
+TRACE_STATE = {"rate": TRACE_SAMPLE_RATE}
+
+def _update_payload(update):
+    for attr in ("message", "edited_message", "callback_query", "chat_member"):
+        payload = getattr(update, attr, None)
+        if payload is not None:
+            return payload
+    return None
+
+def maybe_trace(update):
+    """Start a trace for a sampled share of updates; returns the Trace or None.
+
+    The trace is attached to the update's message/callback object, so the
+    handler picks it up even when telebot runs it on another thread.
+    """
+    rate = TRACE_STATE["rate"]
+    if rate <= 0 or random.random() >= rate:
+        return None
+    payload = _update_payload(update)
+    if payload is None:
+        return None
+    trace = Trace(update.update_id)
+    payload._trace = trace
+    with _TRACES_LOCK:
+        TRACES[update.update_id] = trace
+        while len(TRACES) > TRACE_KEEP:
+            TRACES.popitem(last=False)
+    return trace
+
+class trace_span:
+    """Context manager recording a child span of the current one (no-op outside a trace)."""
+
+    __slots__ = ("name", "_token", "_span")
+
+    def __init__(self, name):
+        self.name = name
+        self._token = None
+
+    def __enter__(self):
+        current = CURRENT_SPAN.get()
+        if current is not None:
+            trace, parent = current
+            self._span = trace.add(parent, self.name, time.monotonic())
+            self._token = CURRENT_SPAN.set((trace, self._span))
+        return self
+
+    def __exit__(self, *exc):
+        if self._token is not None:
+            self._span.end = time.monotonic()
+            CURRENT_SPAN.reset(self._token)
+        return False
+
+def record_span(name, start, end):
+    """Add an already finished span (monotonic times) under the current one."""
+    current = CURRENT_SPAN.get()
+    if current is not None:
+        trace, parent = current
+        trace.add(parent, name, start, end)
+
+def _activate_trace(args):
+    trace = getattr(args[0], "_trace", None) if args else None
+    return CURRENT_SPAN.set((trace, trace.root)) if trace is not None else None
+
+def render_trace_text(node, depth=0):
+    lines = [f"{'  ' * depth}{node['name']}  {node['duration_ms']}ms (+{node['start_ms']})"]
+    for child in node["children"]:
+        lines.extend(render_trace_text(child, depth + 1))
+    return lines
+
+def instrumented(name):
+    """Decorator: time a helper as bot_function_duration_seconds{function=name} and count its errors."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                with trace_span(name):
+                    return fn(*args, **kwargs)
+            except Exception:
+                METRICS.error(name)
+                raise
+            finally:
+                METRICS.observe("bot_function_duration_seconds", time.perf_counter() - start,
+                                function=name, handler=CURRENT_HANDLER.get())
+        return wrapper
+    return decorate
+
+def _instrument_handler(fn):
+    name = fn.__name__
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            token = CURRENT_HANDLER.set(name)
+            trace_token = _activate_trace(args)
+            start = time.perf_counter()
+            try:
+                with trace_span(f"handler {name}"):
+                    return await fn(*args, **kwargs)
+            except Exception:
+                METRICS.error(name)
+                raise
+            finally:
+                METRICS.observe("bot_handler_duration_seconds", time.perf_counter() - start, handler=name)
+                if trace_token is not None:
+                    CURRENT_SPAN.reset(trace_token)
+                CURRENT_HANDLER.reset(token)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            token = CURRENT_HANDLER.set(name)
+            trace_token = _activate_trace(args)
+            start = time.perf_counter()
+            try:
+                with trace_span(f"handler {name}"):
+                    return fn(*args, **kwargs)
+            except Exception:
+                METRICS.error(name)
+                raise
+            finally:
+                METRICS.observe("bot_handler_duration_seconds", time.perf_counter() - start, handler=name)
+                if trace_token is not None:
+                    CURRENT_SPAN.reset(trace_token)
+                CURRENT_HANDLER.reset(token)
+    wrapper.instrumented = True
+    return wrapper
+
+def instrument_handlers(telebot_instance):
+    """Wrap every handler registered so far on a (Async)TeleBot with timing and error counting."""
+    for attr in ("message_handlers", "callback_query_handlers", "chat_member_handlers"):
+        for handler in getattr(telebot_instance, attr, []):
+            if not getattr(handler["function"], "instrumented", False):
+                handler["function"] = _instrument_handler(handler["function"])
+
+def _backend_operation(backend, method, path):
+    """Low-cardinality name for a backend request; never includes the bot token."""
+    parts = [p for p in path.split("/") if p]
+    if backend == "telegram":
+        # /bot<token>/<apiMethod> or /file/bot<token>/<file path>
+        return "file_download" if parts[:1] == ["file"] else (parts[-1] if parts else "")
+    # supabase: /rest/v1/<table>, /storage/v1/object/<bucket>/...
+    return f"{method} {parts[0]}:{parts[2]}" if len(parts) >= 3 else f"{method} {path}"
+
+def record_backend_call(backend, op, seconds, error):
+    METRICS.observe("bot_backend_duration_seconds", seconds, backend=backend, op=op, handler=CURRENT_HANDLER.get())
+    if error:
+        METRICS.error(f"{backend}:{op}")
+
+class InstrumentedSession(requests.Session):
+    """requests.Session that records every call as a `backend` request in METRICS."""
+
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+
+    def request(self, method, url, *args, **kwargs):
+        op = _backend_operation(self.backend, method, urlsplit(url).path)
+        start = time.perf_counter()
+        error = True
+        try:
+            with trace_span(f"{self.backend} {op}"):
+                response = super().request(method, url, *args, **kwargs)
+            error = response.status_code >= 400
+            return response
+        finally:
+            record_backend_call(self.backend, op, time.perf_counter() - start, error)
+
+class InstrumentedTransport(httpx.BaseTransport):
+    """httpx transport wrapper that records every call as a `backend` request in METRICS."""
+
+    def __init__(self, transport, backend):
+        self._transport = transport
+        self.backend = backend
+
+    def handle_request(self, request):
+        op = _backend_operation(self.backend, request.method, request.url.path)
+        start = time.perf_counter()
+        error = True
+        try:
+            with trace_span(f"{self.backend} {op}"):
+                response = self._transport.handle_request(request)
+            error = response.status_code >= 400
+            return response
+        finally:
+            record_backend_call(self.backend, op, time.perf_counter() - start, error)
+
+    def close(self):
+        self._transport.close()
+
+# -------------------------
+# Networking (shared, explicitly sized connection pools)
+# -------------------------
+def make_http_session(pool_size, backend=None):
+    """A requests session whose pool keeps up to `pool_size` keep-alive connections per host.
+
+    With a `backend` name every request is timed into METRICS.
+    """
+    session = InstrumentedSession(backend) if backend else requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def http_pool_stats(session):
+    """Connections opened vs requests served across a session's pools."""
+    opened = served = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            opened += pool.num_connections
+            served += pool.num_requests
+    return {
+        "connections_opened": opened,
+        "requests": served,
+        "reuse_ratio": 1 - opened / served if served else 0.0,
+    }
+
+TELEGRAM_HTTP = make_http_session(TELEGRAM_POOL_SIZE, "telegram")  # Bot API calls and file downloads
+SUPABASE_HTTP = make_http_session(SUPABASE_POOL_SIZE, "supabase")  # streamed storage uploads
+PING_HTTP = make_http_session(1)  # auto_ping
+
+# telebot uses apihelper.session for every thread when it is set
+telebot.apihelper.session = TELEGRAM_HTTP
+telebot.apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+telebot.apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+
+SUPABASE_REQUESTS = {"count": 0}  # the httpx pool has no counters of its own
+
+def _count_supabase_request(_request):
+    SUPABASE_REQUESTS["count"] += 1
+
+def _supabase_options():
+    timeouts = dict(postgrest_client_timeout=HTTP_READ_TIMEOUT, storage_client_timeout=HTTP_READ_TIMEOUT)
+    transport = httpx.HTTPTransport(limits=httpx.Limits(
+        max_connections=SUPABASE_POOL_SIZE,
+        max_keepalive_connections=SUPABASE_POOL_SIZE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    ))
+    client = httpx.Client(
+        transport=InstrumentedTransport(transport, "supabase"),
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        event_hooks={"request": [_count_supabase_request]},
+    )
+    try:
+        return ClientOptions(httpx_client=client, **timeouts)
+    except TypeError:
+        # supabase-py before httpx_client support: keep its own pools, set timeouts only
+        client.close()
+        return ClientOptions(**timeouts)
+
+def connection_stats():
+    return {
+        "telegram": http_pool_stats(TELEGRAM_HTTP),
+        "supabase_storage_uploads": http_pool_stats(SUPABASE_HTTP),
+        "supabase_requests": SUPABASE_REQUESTS["count"],
+        "ping": http_pool_stats(PING_HTTP),
+    }
+
+# In queue mode our own workers run the handlers, so telebot dispatches inline.
+bot = telebot.TeleBot(BOT_TOKEN, threaded=not WEBHOOK_QUEUE_ENABLED, num_threads=20)
 app = Flask(__name__)
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY, options=_supabase_options())
+USER_REPLICA = UserReplica(USER_REPLICA_PATH) if USER_REPLICA_PATH else None
+users_repo = UsersRepository(supabase, replica=USER_REPLICA)
+payments_repo = PaymentsRepository(supabase)
+messages_repo = MessagesRepository(supabase)
+
+# -------------------------
+# Background threads
+# -------------------------
+_BACKGROUND_LOCK = threading.Lock()
+_BACKGROUND_PIDS = {}  # name -> pid of the process that started it
+
+def start_background_thread(name, target, count=1):
+    """Start `count` daemon threads running `target` once per process.
+
+    Threads don't survive a gunicorn fork, so this is keyed by pid and is
+    called lazily from the code paths that need the threads.
+    """
+    pid = os.getpid()
+    if _BACKGROUND_PIDS.get(name) == pid:
+        return
+    with _BACKGROUND_LOCK:
+        if _BACKGROUND_PIDS.get(name) == pid:
+            return
+        for i in range(count):
+            threading.Thread(target=target, name=f"{name}-{i}", daemon=True).start()
+        _BACKGROUND_PIDS[name] = pid
+
+# -------------------------
+# Job scheduler
+# -------------------------
+class _Job:
+    __slots__ = ("name", "fn", "interval", "jitter", "backoff_max", "single_instance", "due", "running",
+                 "failures", "lock_fd", "lock_pid", "runs", "errors", "skipped", "total_time", "max_time",
+                 "last_time", "last_run", "last_error", "rerun_after")
+
+    def __init__(self, name, fn, interval, jitter, backoff_max, single_instance):
+        self.name = name
+        self.fn = fn
+        self.interval = interval  # None for one-off jobs
+        self.jitter = jitter
+        self.backoff_max = backoff_max
+        self.single_instance = single_instance
+        self.due = None
+        self.running = False
+        self.failures = 0  # consecutive, drives the backoff
+        self.lock_fd = None
+        self.lock_pid = None
+        self.runs = 0
+        self.errors = 0
+        self.skipped = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_time = 0.0
+        self.last_run = None
+        self.last_error = None
+        self.rerun_after = None  # one-off asked for again while running: delay for the next run
+
+class Scheduler:
+    """Periodic and delayed jobs for every background task of the process.
+
+    One dispatcher thread hands due jobs to a small worker pool; a job never
+    overlaps itself. Periodic runs are spread by +/- `jitter` (a fraction of
+    the interval) and a failing job backs off exponentially up to
+    `backoff_max`. A `single_instance` job runs only in the worker holding
+    its flock; the lock passes on when that process exits. Nothing runs
+    until start(), which is called from worker processes only (see
+    start_background_work), never from a gunicorn --preload master.
+    """
+
+    def __init__(self, workers, lock_dir):
+        self.workers = workers
+        self.lock_dir = lock_dir
+        self._jobs = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._heap = []  # (due, seq, job)
+        self._runnable = queue.Queue()
+
+    def _push(self, job, due):
+        # caller holds self._cond
+        job.due = due
+        heapq.heappush(self._heap, (due, next(self._seq), job))
+        self._cond.notify()
+
+    def every(self, name, interval, fn, jitter=0.1, backoff_max=None, single_instance=False, first_delay=None):
+        """Run fn() every `interval` seconds (first run after `first_delay`, default one interval)."""
+        job = _Job(name, fn, interval, jitter, backoff_max or interval * 8, single_instance)
+        with self._cond:
+            self._jobs[name] = job
+            self._push(job, time.monotonic() + (interval if first_delay is None else first_delay))
+        return job
+
+    def after(self, delay, name, fn):
+        """Run fn() once, `delay` seconds from now.
+
+        No-op if `name` is already pending; if it is running right now, it is
+        run once more `delay` seconds after it finishes.
+        """
+        with self._cond:
+            job = self._jobs.get(name)
+            if job is not None and job.running:
+                job.rerun_after = delay if job.rerun_after is None else min(job.rerun_after, delay)
+                return job
+            if job is not None and job.due is not None:
+                return job
+            job = self._jobs[name] = _Job(name, fn, None, 0, 0, False)
+            self._push(job, time.monotonic() + delay)
+        self.start()
+        return job
+
+    def trigger(self, name):
+        """Run a registered job as soon as possible (next periodic run is rescheduled after it)."""
+        with self._cond:
+            job = self._jobs.get(name)
+            if job is not None and not job.running and job.due is not None and job.due > time.monotonic():
+                self._push(job, time.monotonic())
+
+    def start(self):
+        start_background_thread("scheduler", self._dispatch)
+        start_background_thread("scheduler-worker", self._work, count=self.workers)
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    due, _, job = heapq.heappop(self._heap)
+                    if job.due != due or job.running:
+                        continue  # superseded by trigger() or a reschedule
+                    job.due = None
+                    job.running = True
+                    self._runnable.put(job)
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _holds_lock(self, job):
+        if job.lock_pid == os.getpid():
+            return True
+        if job.lock_fd is not None:
+            os.close(job.lock_fd)  # inherited across fork; the parent keeps its lock
+            job.lock_fd = None
+        os.makedirs(self.lock_dir, exist_ok=True)
+        fd = os.open(os.path.join(self.lock_dir, f"{job.name}.lock"), os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        job.lock_fd, job.lock_pid = fd, os.getpid()
+        return True
+
+    def _work(self):
+        while True:
+            job = self._runnable.get()
+            delay = job.interval
+            try:
+                if job.single_instance and not self._holds_lock(job):
+                    job.skipped += 1
+                else:
+                    self._run_job(job)
+                    if job.failures and job.interval:
+                        delay = min(job.interval * 2 ** job.failures, job.backoff_max)
+            except Exception as e:
+                logger.warning("Scheduler could not run %s: %s", job.name, e)
+            with self._cond:
+                job.running = False
+                if delay is None and job.rerun_after is not None:
+                    delay, job.rerun_after = job.rerun_after, None
+                if delay is not None:
+                    spread = delay * job.jitter
+                    self._push(job, time.monotonic() + delay + random.uniform(-spread, spread))
+                elif self._jobs.get(job.name) is job:
+                    del self._jobs[job.name]
+
+    def _run_job(self, job):
+        start = time.perf_counter()
+        job.last_run = time.time()
+        try:
+            job.fn()
+            job.failures = 0
+        except Exception as e:
+            job.failures += 1
+            job.errors += 1
+            job.last_error = str(e)
+            METRICS.error(f"job:{job.name}")
+            logger.warning("Job %s failed (%d in a row): %s", job.name, job.failures, e)
+        finally:
+            elapsed = time.perf_counter() - start
+            job.runs += 1
+            job.total_time += elapsed
+            job.max_time = max(job.max_time, elapsed)
+            job.last_time = elapsed
+            METRICS.observe("bot_job_duration_seconds", elapsed, job=job.name)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._cond:
+            jobs = list(self._jobs.values())
+        return {
+            job.name: {
+                "interval": job.interval,
+                "runs": job.runs,
+                "errors": job.errors,
+                "skipped_not_leader": job.skipped,
+                "leader": job.lock_pid == os.getpid() if job.single_instance else None,
+                "running": job.running,
+                "next_in": round(job.due - now, 3) if job.due is not None else None,
+                "last_seconds": round(job.last_time, 4),
+                "avg_seconds": round(job.total_time / job.runs, 4) if job.runs else 0.0,
+                "max_seconds": round(job.max_time, 4),
+                "last_run": job.last_run,
+                "last_error": job.last_error,
+            }
+            for job in jobs
+        }
+
+SCHEDULER = Scheduler(
+    SCHEDULER_WORKERS,
+    SCHEDULER_LOCK_DIR or os.path.join(tempfile.gettempdir(), f"bot-{BOT_TOKEN.split(':')[0]}-jobs"),
+)
+
+# -------------------------
+# Cross-worker invalidation bus
+# -------------------------
+# Each worker binds CACHE_BUS_DIR/<pid>.sock (datagram). An invalidation is
+# applied locally and sent to every other socket in the directory; sockets
+# left behind by dead workers refuse the datagram and are removed.
+_BUS_HANDLERS = {}  # kind -> fn(key)
+BUS_STATS = {"sent": 0, "received": 0, "stale_sockets": 0}
+
+def on_bus_message(kind, handler):
+    _BUS_HANDLERS[kind] = handler
+
+def _bus_socket_path(pid):
+    return os.path.join(CACHE_BUS_DIR, f"{pid}.sock")
+
+def _bus_listener():
+    path = _bus_socket_path(os.getpid())
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock.bind(path)
+    while True:
+        data = sock.recv(4096)
+        try:
+            msg = json.loads(data)
+            _BUS_HANDLERS[msg["kind"]](msg["key"])
+            BUS_STATS["received"] += 1
+        except Exception as e:
+            logger.warning("Bad cache bus message %r: %s", data, e)
+
+def start_cache_bus():
+    """Make sure this worker listens for invalidations (no-op without CACHE_BUS_DIR)."""
+    if not CACHE_BUS_DIR:
+        return
+    os.makedirs(CACHE_BUS_DIR, exist_ok=True)
+    start_background_thread("cache-bus", _bus_listener)
+
+def publish_invalidation(kind, key):
+    """Apply an invalidation here and broadcast it to the other workers."""
+    _BUS_HANDLERS[kind](key)
+    if not CACHE_BUS_DIR:
+        return
+    start_cache_bus()
+    payload = json.dumps({"kind": kind, "key": key}).encode()
+    own = os.path.basename(_bus_socket_path(os.getpid()))
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        for name in os.listdir(CACHE_BUS_DIR):
+            if not name.endswith(".sock") or name == own:
+                continue
+            path = os.path.join(CACHE_BUS_DIR, name)
+            try:
+                sender.sendto(payload, path)
+                BUS_STATS["sent"] += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                BUS_STATS["stale_sockets"] += 1
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                logger.warning("Cache bus send to %s failed: %s", name, e)
+    finally:
+        sender.close()
 
 # -------------------------
 # Constants
@@ -61,19 +878,6 @@ CHANNEL_URL = f"https://t.me/{CHANNEL_USERNAME.lstrip('@')}"
 
 UPI_ID = "MillionaireNaitik69@fam"
 QR_IMAGE_URL = "https://mruser96.42web.io/qr.jpg?nocache="
-COURSES_MESSAGE = (
-    "📚 *GxNSS COURSES*\n\n"
-    "🔹 *Programming Courses*\n"
-    "C++\nJava\nJavaScript\nPython\n\n"
-    "🔹 *Hacking & Cybersecurity Courses*\n"
-    "BlackHat Hacking\nEthical Hacking\nAndroid Hacking\nWiFi Hacking\n"
-    "Binning (by BlackHat)\nPhishing App Development\nPUBG Hack Development\nAPK Modding (20+ Courses)\n\n"
-    "🔹 *System & OS Courses*\n"
-    "Linux\nPowerShell\n\n"
-    "🔹 *Special Cyber Tools Courses*\n"
-    "How to Make Telegram Number\nHow to Make Lifetime RDP\nHow to Call Any Indian Number Free\n"
-    "How to Make Own SMS Bomber\nHow to Make Own Temporary Mail Bot.)"
-)
 PROMO_MESSAGE = (
     "🚀 *Huge Course Bundle – Just ₹79!* (Originally ₹199)\n\n"
     "Get 30+ premium courses with guaranteed results. Don’t miss this offer!"
@@ -85,208 +889,1132 @@ PAYMENT_INSTRUCTIONS = (
     "2. Click *I Paid (Upload Screenshot)* below to upload proof.\n\n"
     "We’ll verify and grant access."
 )
+QR_CAPTION = f"{PAYMENT_INSTRUCTIONS}\n\n👇 After payment, click the button below."
+JOIN_PROMPT = (
+    f"💬 *Please join our Telegram channel first to access courses.*\n\n"
+    f"Channel: {CHANNEL_USERNAME}\n\n"
+    "Click *Join Channel* then come back and press *Try Again*."
+)
+JOIN_REMINDER = (
+    f"💬 You still need to join {CHANNEL_USERNAME} before continuing.\n\n"
+    f"Click *Join Channel* and then *Try Again*."
+)
+UPLOAD_PROMPT = "✅ Please upload your payment screenshot here.\n\nMake sure the screenshot clearly shows the transaction details."
+UPLOAD_NOT_REQUESTED = "⚠️ Please click *I Paid (Upload Screenshot)* before sending a screenshot."
+UPLOAD_RECEIVED = (
+    "❤️‍🔥 Payment screenshot received!\n\n"
+    "Admin will verify your payment shortly. If approved, you'll be upgraded to Premium. 🚀"
+)
+UPLOAD_DUPLICATE = (
+    "✅ We already received this screenshot.\n\n"
+    "Admin will verify your payment shortly. If approved, you'll be upgraded to Premium. 🚀"
+)
+UPGRADE_NOTICE = "💲 We upgraded you to Premium User!\n\nClick /start to access your courses 🚀"
+
+# inline keyboards shared by the sync and async handlers
+JOIN_MARKUP = types.InlineKeyboardMarkup()
+JOIN_MARKUP.add(types.InlineKeyboardButton("🔗 Join Channel", url=CHANNEL_URL))  # join button uses URL
+JOIN_MARKUP.add(types.InlineKeyboardButton("✅ Try Again", callback_data="check_join"))  # re-checks membership
+BUY_MARKUP = types.InlineKeyboardMarkup()
+BUY_MARKUP.add(types.InlineKeyboardButton("Buy Course For ₹79", callback_data="buy"))
+PAID_MARKUP = types.InlineKeyboardMarkup()
+PAID_MARKUP.add(types.InlineKeyboardButton("I Paid (Upload Screenshot)", callback_data="i_paid"))
+
+def payment_notice(user, user_id, url):
+    """Admin notice for a new payment screenshot (`user` is the Telegram sender)."""
+    return f"🆕 Payment uploaded by @{user.username or user.id}\nUserID: {user_id}\nURL: {url}"
 
 # -------------------------
 # Small in-memory cache to reduce DB calls (helps on free hosts)
 # -------------------------
-USER_CACHE = {}  # telegram_id -> (status, expire_ts)
-USER_CACHE_TTL = 30  # seconds
+class TTLCache:
+    """Thread-safe LRU cache with per-entry expiry and hit/miss counters.
 
+    Expired entries are dropped on lookup and by a periodic background sweep;
+    once `maxsize` is reached the least recently used entry is evicted.
+    """
+
+    def __init__(self, name, maxsize, ttl, sweep_interval=60):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._data = OrderedDict()  # key -> (expire_ts, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        SCHEDULER.every(f"cache-sweep-{name}", sweep_interval, self.sweep)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expire_ts, value = entry
+            if expire_ts <= now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expire_ts = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expire_ts, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def sweep(self):
+        """Drop all expired entries. Returns how many were removed."""
+        now = time.time()
+        with self._lock:
+            expired = [k for k, (expire_ts, _) in self._data.items() if expire_ts <= now]
+            for k in expired:
+                del self._data[k]
+            self.expirations += len(expired)
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into one in-flight call.
+
+    The first caller runs the function; callers arriving while it runs wait
+    and receive the same result (or exception).
+    """
+
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> _Call
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._calls)}
+
+
+# with the invalidation bus, upgrades reach every worker at once, so entries can live longer
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "600" if CACHE_BUS_DIR else "30"))  # seconds
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", "20000"))
+USER_NEGATIVE_TTL = int(os.getenv("USER_NEGATIVE_TTL", "5"))  # seconds to remember unknown users
+USER_CACHE = TTLCache("users", USER_CACHE_MAX, USER_CACHE_TTL)  # telegram_id -> UserRow
+USER_NOT_FOUND = object()  # cached marker for telegram_ids with no users row
+USER_LOOKUPS = SingleFlight()
+
+def _fetch_user(telegram_id):
+    user_row = users_repo.get_by_telegram_id(telegram_id)
+    if user_row:
+        USER_CACHE.set(telegram_id, user_row)
+    else:
+        USER_CACHE.set(telegram_id, USER_NOT_FOUND, ttl=USER_NEGATIVE_TTL)
+    return user_row
+
+@instrumented("get_user_cached")
 def get_user_cached(telegram_id):
-    """Return user row from cache or DB. Cache only status and id for speed."""
-    now = time.time()
+    """Return the UserRow from cache or DB, or None if there is no such user.
+
+    Concurrent misses for one id share a single query, and unknown users are
+    cached for USER_NEGATIVE_TTL, so callers should not re-query on None.
+    """
+    try:
+        telegram_id = int(telegram_id)
+    except Exception:
+        pass
     cached = USER_CACHE.get(telegram_id)
-    if cached:
-        status, expire_ts, user_row = cached
-        if expire_ts > now:
-            return user_row
+    if cached is USER_NOT_FOUND:
+        return None
+    if cached is not None:
+        return cached
+    replica_row = replica_get_user(telegram_id)
+    if replica_row is not None:
+        USER_CACHE.set(telegram_id, replica_row)
+        return replica_row
+    try:
+        return USER_LOOKUPS.do(telegram_id, lambda: _fetch_user(telegram_id))
+    except Exception as e:
+        # DB errors are not cached; the next lookup retries
+        logger.warning("User lookup failed for %s: %s", telegram_id, e)
+        return None
+
+def replica_get_user(telegram_id):
+    """UserRow from the local replica, or None if disabled, not loaded yet or missing."""
+    if USER_REPLICA is None:
+        return None
+    try:
+        if USER_REPLICA.ready:
+            return USER_REPLICA.get(telegram_id)
+    except Exception as e:
+        logger.warning("User replica read failed: %s", e)
+    return None
+
+def sync_user_replica():
+    applied = USER_REPLICA.sync_from(users_repo)
+    if applied:
+        logger.info("User replica applied %d changed rows", applied)
+
+if USER_REPLICA is not None:
+    # the replica file is shared, so one worker per host keeps it in sync
+    SCHEDULER.every("user-replica-sync", USER_REPLICA_SYNC_INTERVAL, sync_user_replica,
+                    single_instance=True, first_delay=0)
+
+on_bus_message("user", USER_CACHE.invalidate)
+
+def invalidate_user_cache(telegram_id):
+    """Drop the user from USER_CACHE in every worker."""
+    publish_invalidation("user", telegram_id)
+
+# -------------------------
+# Premium index
+# -------------------------
+class PremiumIndex:
+    """Premium telegram_ids held in memory, so menu traffic needs no user lookup.
+
+    The first sync() loads every premium id; later ones apply rows changed
+    since the last sync (upgrades and downgrades), re-reading an overlap
+    window each time. Every `reload_interval` seconds the set is rebuilt from
+    scratch as a backstop. Upgrades made by any worker are added at once
+    through the bus. contains() returns None until the first load has
+    finished, so callers can fall back to a lookup.
+    """
+
+    def __init__(self, repo, page_size=1000, reload_interval=3600):
+        self.repo = repo
+        self.page_size = page_size
+        self.reload_interval = reload_interval
+        self._ids = set()
+        self._added_during_load = None  # bus upgrades seen while a load runs
+        self._lock = threading.Lock()
+        self._since = None
+        self._loaded_at = 0.0
+        self.ready = False
+        self.full_loads = 0
+        self.delta_syncs = 0
+        self.last_sync = None
+
+    def contains(self, telegram_id):
+        if not self.ready:
+            return None
+        return int(telegram_id) in self._ids
+
+    def add(self, telegram_id):
+        with self._lock:
+            self._ids.add(int(telegram_id))
+            if self._added_during_load is not None:
+                self._added_during_load.add(int(telegram_id))
+
+    def sync(self):
+        if self.ready and time.monotonic() - self._loaded_at < self.reload_interval:
+            self._apply_changes()
         else:
-            USER_CACHE.pop(telegram_id, None)
-    # fallback to DB
+            self._load_all()
+        self.last_sync = time.time()
+
+    def _load_all(self):
+        started = datetime.utcnow().isoformat()
+        with self._lock:
+            self._added_during_load = set()
+        ids = set()
+        after_id = None
+        try:
+            while True:
+                rows = self.repo.list_premium_ids(after_id, self.page_size)
+                ids.update(int(r["telegram_id"]) for r in rows)
+                if len(rows) < self.page_size:
+                    break
+                after_id = rows[-1]["id"]
+        except Exception:
+            with self._lock:
+                self._added_during_load = None
+            raise
+        with self._lock:
+            # replace, so downgrades a delta missed are dropped; keep bus upgrades from meanwhile
+            self._ids = ids | self._added_during_load
+            self._added_during_load = None
+        self._since = started  # the next delta re-reads the overlap window before it
+        self._loaded_at = time.monotonic()
+        self.ready = True
+        self.full_loads += 1
+        logger.info("Premium index loaded %d users", len(ids))
+
+    def _apply_changes(self):
+        def apply(rows):
+            with self._lock:
+                for r in rows:
+                    if (r.get("status") or "").lower() == "premium":
+                        self._ids.add(int(r["telegram_id"]))
+                    else:
+                        self._ids.discard(int(r["telegram_id"]))
+        self._since = self.repo.pull_changes(self._since, apply, self.page_size, columns="telegram_id,status,updated_at")
+        self.delta_syncs += 1
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "size": len(self._ids),
+            "full_loads": self.full_loads,
+            "delta_syncs": self.delta_syncs,
+            "last_sync": self.last_sync,
+        }
+
+PREMIUM_INDEX = PremiumIndex(users_repo, reload_interval=PREMIUM_INDEX_RELOAD_INTERVAL)
+on_bus_message("premium", PREMIUM_INDEX.add)
+SCHEDULER.every("premium-index-sync", PREMIUM_INDEX_SYNC_INTERVAL, PREMIUM_INDEX.sync, first_delay=0)
+
+def is_premium_user(telegram_id):
+    """Premium check from the index; falls back to the user lookup until it is loaded."""
+    premium = PREMIUM_INDEX.contains(telegram_id)
+    if premium is None:
+        user_row = get_user_cached(telegram_id)
+        premium = bool(user_row and user_row.is_premium)
+    return premium
+
+# -------------------------
+# Outbound Telegram send scheduler
+# -------------------------
+# Every send goes through `outbox`, which enforces Telegram's global and
+# per-chat limits, retries 429s after retry_after and serves user-facing
+# replies before admin and bulk traffic.
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+PRIORITY_BULK = 2
+
+# The buckets live in each process. SEND_GLOBAL_RATE is the bot's total and is
+# split evenly over SEND_PROCESSES (default WEB_CONCURRENCY, which gunicorn also
+# reads for its worker count): set it when running more than one worker.
+# Per-chat buckets are per process too, since a chat's updates can reach any
+# worker; a chat pushed past Telegram's limit gets 429s, which are retried.
+SEND_PROCESSES = max(1, int(os.getenv("SEND_PROCESSES", os.getenv("WEB_CONCURRENCY", "1"))))
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "28"))  # messages/second across all chats, all processes
+SEND_PROCESS_RATE = SEND_GLOBAL_RATE / SEND_PROCESSES  # this process's share
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))  # messages/second per chat, per process
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "8"))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "4"))
+SEND_CHAT_BUCKETS_MAX = 10000  # idle per-chat buckets are pruned above this
+
+def telegram_retry_after(e):
+    """Seconds Telegram asked us to wait for a 429 error, or None for other errors."""
+    if getattr(e, "error_code", None) != 429:
+        return None
     try:
-        resp = supabase.table("users").select("*").eq("telegram_id", int(telegram_id)).single().execute()
-        user_row = resp.data
+        return float(e.result_json["parameters"]["retry_after"])
     except Exception:
-        user_row = None
-    # cache minimal info for short time
-    expire_ts = now + USER_CACHE_TTL
-    USER_CACHE[telegram_id] = (user_row.get("status") if user_row else None, expire_ts, user_row)
-    return user_row
+        return 1.0
+
+class TokenBucket:
+    """Token bucket rate limiter. Not locked; OutboundScheduler guards it."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now):
+        """Seconds until a token is available (0.0 if one is available now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self, now):
+        return self.blocked_until <= now and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class _SendJob:
+    __slots__ = ("priority", "chat_id", "method", "args", "kwargs", "future", "enqueued", "attempts", "context")
+
+    def __init__(self, priority, chat_id, method, args, kwargs):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+        self.context = contextvars.copy_context()  # so the send is attributed to the submitting handler
+
+class OutboundScheduler:
+    """Priority queue of bot API calls drained by a small pool of sender threads.
+
+    `submit` returns a Future; calling a bot method on the scheduler itself
+    (e.g. `outbox.send_message(...)`) blocks until it was sent and returns the
+    result, so it is a drop-in for the plain bot call.
+    """
 
-def invalidate_user_cache(telegram_id):
-    USER_CACHE.pop(telegram_id, None)
+    METHODS = ("send_message", "send_photo", "send_document", "reply_to",
+               "edit_message_text", "delete_message", "delete_messages")
+
+    def __init__(self, bot, workers, global_rate, chat_rate, chat_burst):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._cond = threading.Condition()
+        self._ready = []  # heap of (priority, seq, job)
+        self._delayed = []  # heap of (not_before, seq, job)
+        self._seq = itertools.count()
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._chats = {}  # chat_id -> TokenBucket
+        self.sent = 0
+        self.failed = 0
+        self.retried_429 = 0
+        self.chat_throttled = 0
+        self.global_throttled = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+
+    @staticmethod
+    def _chat_of(method, args, kwargs):
+        if "chat_id" in kwargs:
+            return kwargs["chat_id"]
+        if method == "reply_to":
+            return args[0].chat.id
+        return args[0]
+
+    def submit(self, method, *args, priority=PRIORITY_USER, **kwargs):
+        job = _SendJob(priority, self._chat_of(method, args, kwargs), method, args, kwargs)
+        with self._cond:
+            heapq.heappush(self._ready, (priority, next(self._seq), job))
+            self._cond.notify()
+        start_background_thread("outbound-sender", self._run, count=self.workers)
+        return job.future
+
+    def call(self, method, *args, priority=PRIORITY_USER, **kwargs):
+        return self.submit(method, *args, priority=priority, **kwargs).result()
+
+    def __getattr__(self, name):
+        if name not in self.METHODS:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= SEND_CHAT_BUCKETS_MAX:
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _take_job(self, now):
+        """Pop the next job allowed out now: (job, None), or (None, seconds to wait or None). Caller holds the lock."""
+        while self._delayed and self._delayed[0][0] <= now:
+            _, seq, job = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (job.priority, seq, job))
+        wait = None
+        if self._ready:
+            wait = self._global.delay(now)
+            if wait > 0:
+                self.global_throttled += 1
+            else:
+                while self._ready:
+                    _, seq, job = heapq.heappop(self._ready)
+                    bucket = self._chat_bucket(job.chat_id, now)
+                    chat_wait = bucket.delay(now)
+                    if chat_wait <= 0:
+                        bucket.take()
+                        self._global.take()
+                        return job, None
+                    # this chat is over its limit: park the job, try the next one
+                    self.chat_throttled += 1
+                    heapq.heappush(self._delayed, (now + chat_wait, seq, job))
+                wait = None
+        if self._delayed:
+            until_due = self._delayed[0][0] - now
+            wait = until_due if wait is None else min(wait, until_due)
+        return None, wait
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                job, wait = self._take_job(time.monotonic())
+                if job is not None:
+                    return job
+                self._cond.wait(wait)
+
+    def _requeue(self, job, delay):
+        with self._cond:
+            bucket = self._chat_bucket(job.chat_id, time.monotonic())
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + delay)
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), job))
+            self._cond.notify()
+
+    def _started(self, job):
+        if job.attempts == 0:
+            queued = time.monotonic() - job.enqueued
+            with self._cond:
+                self.delay_total += queued
+                self.delay_max = max(self.delay_max, queued)
+            METRICS.observe("bot_outbox_queue_seconds", queued, priority=job.priority)
+        job.attempts += 1
+
+    def _finished(self, job, result=None, error=None):
+        """Resolve the job's future, or requeue it if Telegram answered 429 and attempts remain."""
+        if error is not None:
+            retry_after = telegram_retry_after(error)
+            if retry_after is not None and job.attempts < SEND_MAX_ATTEMPTS:
+                with self._cond:
+                    self.retried_429 += 1
+                logger.warning("Telegram 429 on %s to %s, retrying in %ss", job.method, job.chat_id, retry_after)
+                self._requeue(job, retry_after)
+                return
+            with self._cond:
+                self.failed += 1
+            job.future.set_exception(error)
+            return
+        with self._cond:
+            self.sent += 1
+        job.future.set_result(result)
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            self._started(job)
+            try:
+                result = job.context.run(self._send, job, time.monotonic())
+            except Exception as e:
+                self._finished(job, error=e)
+                continue
+            self._finished(job, result)
+
+    def _send(self, job, dequeued):
+        """Runs inside the submitter's context, so traces and metrics follow the job."""
+        record_span(f"outbox wait {job.method}", job.enqueued, dequeued)
+        with trace_span(f"outbox {job.method}"):
+            return getattr(self.bot, job.method)(*job.args, **job.kwargs)
+
+    def stats(self):
+        with self._cond:
+            started = self.sent + self.failed
+            return {
+                "queued": len(self._ready),
+                "delayed": len(self._delayed),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried_429": self.retried_429,
+                "chat_throttled": self.chat_throttled,
+                "global_throttled": self.global_throttled,
+                "queue_delay_avg": self.delay_total / started if started else 0.0,
+                "queue_delay_max": self.delay_max,
+            }
+
+
+outbox = OutboundScheduler(bot, SEND_WORKERS, SEND_PROCESS_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST)
 
 # -------------------------
 # Helpers
 # -------------------------
 
+MEMBER_CACHE_TTL = int(os.getenv("MEMBER_CACHE_TTL", "900"))  # seconds to trust a "joined" result
+NON_MEMBER_CACHE_TTL = int(os.getenv("NON_MEMBER_CACHE_TTL", "20"))  # seconds to trust a "not joined" result
+MEMBER_CACHE = TTLCache("channel_members", USER_CACHE_MAX, MEMBER_CACHE_TTL)  # user_id -> bool
+MEMBER_LOOKUPS = SingleFlight()
+
+on_bus_message("member", MEMBER_CACHE.invalidate)
+
+def record_channel_membership(user_id: int, joined: bool, broadcast=False):
+    """Cache a membership result; `broadcast` drops stale copies in other workers."""
+    if broadcast:
+        publish_invalidation("member", int(user_id))
+    MEMBER_CACHE.set(int(user_id), joined, ttl=MEMBER_CACHE_TTL if joined else NON_MEMBER_CACHE_TTL)
+
+def _fetch_channel_membership(user_id: int) -> bool:
+    # get_chat_member will raise if bot lacks permission or user isn't found
+    cm = bot.get_chat_member(CHANNEL_USERNAME, user_id)
+    status = getattr(cm, "status", None)
+    # statuses like 'left' or 'kicked' mean not a member;
+    # 'member', 'administrator', 'creator', 'restricted' -> treat as joined
+    joined = status not in ("left", "kicked", None)
+    record_channel_membership(user_id, joined)
+    return joined
+
+@instrumented("is_member_of_channel")
 def is_member_of_channel(user_id: int) -> bool:
     """
     Return True if the user is a member of CHANNEL_USERNAME (or False otherwise).
     Requires the bot to be admin in the channel to reliably check membership.
+    Results are cached (see MEMBER_CACHE_TTL / NON_MEMBER_CACHE_TTL) and kept
+    current from the channel's chat_member updates.
     """
+    cached = MEMBER_CACHE.get(int(user_id))
+    if cached is not None:
+        return cached
     try:
-        # get_chat_member will raise if bot lacks permission or user isn't found
-        cm = bot.get_chat_member(CHANNEL_USERNAME, user_id)
-        status = getattr(cm, "status", None)
-        # statuses like 'left' or 'kicked' mean not a member
-        if status in ("left", "kicked", None):
-            return False
-        # 'member', 'administrator', 'creator', 'restricted' -> treat as joined
-        return True
+        return MEMBER_LOOKUPS.do(int(user_id), lambda: _fetch_channel_membership(user_id))
     except Exception as e:
         # Could be ApiException if bot is not admin or username invalid.
         logger.info("is_member_of_channel check failed for user %s: %s", user_id, e)
-        # Fail-safe: treat as not member
+        # Fail-safe: treat as not member (not cached, so the next check retries)
         return False
 
-
-
 def is_admin(user_id: int) -> bool:
     try:
         return int(user_id) in ADMIN_IDS
     except Exception:
         return False
 
+# Admin notices are handed to the outbox and never waited on. With
+# ADMIN_DIGEST_WINDOW > 0, notices within the window are combined into one
+# message per admin.
+ADMIN_DIGEST_WINDOW = float(os.getenv("ADMIN_DIGEST_WINDOW", "0"))  # seconds; 0 = send each notice at once
+ADMIN_MESSAGE_LIMIT = 3500  # stay well under Telegram's 4096 chars
+ADMIN_FLUSH_TIMEOUT = 5  # seconds shutdown waits for the last digest to be sent
+_admin_digest = []
+_admin_digest_lock = threading.Lock()
+
+def _log_admin_send_failure(future):
+    e = future.exception()
+    if e is not None:
+        logger.warning("Admin notification failed: %s", e)
+
+def _send_to_admins(text):
+    futures = []
+    for aid in ADMIN_IDS:
+        future = outbox.submit("send_message", aid, text, priority=PRIORITY_ADMIN, disable_web_page_preview=True)
+        future.add_done_callback(_log_admin_send_failure)
+        futures.append(future)
+    return futures
+
+def queue_admin_digest(text):
+    """Add a notice to the digest. True when it opened a new window (the caller schedules the flush)."""
+    with _admin_digest_lock:
+        _admin_digest.append(text)
+        return len(_admin_digest) == 1
+
+def take_admin_digest():
+    """Empty the digest and return its notices combined into as few messages as fit."""
+    with _admin_digest_lock:
+        items = _admin_digest[:]
+        del _admin_digest[:]
+    if len(items) <= 1:
+        return items
+    messages = []
+    current = f"🗂 {len(items)} notifications:\n\n"
+    for item in items:
+        if len(current) + len(item) > ADMIN_MESSAGE_LIMIT:
+            messages.append(current)
+            current = ""
+        current += item + "\n\n"
+    if current:
+        messages.append(current)
+    return messages
+
+def flush_admin_digest():
+    """Send the pending digest now. Returns the outbox futures of the sends."""
+    futures = []
+    for text in take_admin_digest():
+        futures += _send_to_admins(text)
+    return futures
+
+def _flush_admin_digest_at_exit():
+    # the outbox senders are daemon threads: without waiting, the digest dies with the process
+    futures = flush_admin_digest()
+    if futures:
+        wait(futures, timeout=ADMIN_FLUSH_TIMEOUT)
+
+atexit.register(_flush_admin_digest_at_exit)
+
 def notify_admins(text):
     if not ADMIN_IDS:
         return
-    for aid in ADMIN_IDS:
-        try:
-            bot.send_message(aid, text, disable_web_page_preview=True)
-        except Exception:
-            pass
+    if ADMIN_DIGEST_WINDOW <= 0:
+        _send_to_admins(text)
+        return
+    if queue_admin_digest(text):
+        SCHEDULER.after(ADMIN_DIGEST_WINDOW, "admin-digest", flush_admin_digest)
 
+@instrumented("find_or_create_user")
 def find_or_create_user(telegram_id, username, first_name=None, last_name=None):
+    """Return the user's UserRow, registering them on first contact.
+
+    A cached user with an unchanged profile costs no DB call; a changed
+    username/first_name costs one update; a cache miss is a single upsert.
+    """
     try:
         telegram_id = int(telegram_id)
     except Exception:
         pass
-    resp = supabase.table("users").select("*").eq("telegram_id", telegram_id).limit(1).execute()
-    if resp and resp.data:
-        user = resp.data[0]
-        # cache
-        USER_CACHE[telegram_id] = (user.get("status"), time.time() + USER_CACHE_TTL, user)
+    user = USER_CACHE.get(telegram_id)
+    if isinstance(user, UserRow):
+        if user.username == username and user.first_name == first_name:
+            return user
+        try:
+            users_repo.update_profile(telegram_id, username, first_name, last_name)
+            user = user.with_profile(username, first_name)
+            USER_CACHE.set(telegram_id, user)
+        except Exception as e:
+            logger.warning("Profile update failed for %s: %s", telegram_id, e)
         return user
-    new_user = {
-        "telegram_id": telegram_id,
-        "username": username,
-        "first_name": first_name,
-        "last_name": last_name,
-        "status": "normal",
-        "pending_upload": False,
-        "created_at": datetime.utcnow().isoformat(),
-        "updated_at": datetime.utcnow().isoformat(),
-    }
-    ins = supabase.table("users").insert(new_user).execute()
-    user = ins.data[0] if ins.data else None
+    user = users_repo.register(telegram_id, username, first_name, last_name)
     if user:
-        USER_CACHE[telegram_id] = (user.get("status"), time.time() + USER_CACHE_TTL, user)
+        USER_CACHE.set(telegram_id, user)
     return user
 
 def upload_to_supabase(bucket, object_path, file_bytes, content_type="image/jpeg"):
     object_path = object_path.lstrip("/")
     storage = supabase.storage.from_(bucket)
-    try:
-        # remove existing if any
-        storage.remove([object_path])
-    except Exception:
-        pass
-    storage.upload(object_path, file_bytes, {"content-type": content_type})
+    # upsert replaces an existing object in the same request (no separate remove)
+    storage.upload(object_path, file_bytes, {"content-type": content_type, "upsert": "true"})
     return object_path, storage.get_public_url(object_path)
 
-def create_payment(user_row, file_path, file_url, username):
-    payload = {
-        "user_id": user_row["id"],
-        "username": username,
-        "file_path": file_path,
-        "file_url": file_url,
-        "verified": False,
-        "created_at": datetime.utcnow().isoformat(),
-    }
-    res = supabase.table("payments").insert(payload).execute()
-    return res.data[0] if res.data else None
+# -------------------------
+# Streaming uploads (Telegram file -> Supabase storage without holding the file in memory)
+# -------------------------
+UPLOAD_STREAMING = _env_flag("UPLOAD_STREAMING", True)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))  # Bot API download limit
+UPLOAD_TOO_LARGE = f"❌ File is too large. Maximum size is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB."
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_SPOOL_MEMORY = 1024 * 1024  # larger downloads spill to a temp file
+UPLOAD_TIMEOUT = (HTTP_CONNECT_TIMEOUT, 60)  # (connect, read) seconds
 
-def save_message(user_id, chat_id, message_id):
+class UploadTooLarge(Exception):
+    pass
+
+def telegram_file_url(file_path):
+    template = telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}"
+    return template.format(BOT_TOKEN, file_path)
+
+def download_to_spool(file_path, timings):
+    """Download a Telegram file in chunks into a spooled temp file.
+
+    Returns (spool, sha256 hex digest); the spool is rewound and must be closed
+    by the caller. Raises UploadTooLarge past MAX_UPLOAD_BYTES.
+    """
+    started = time.monotonic()
+    digest = hashlib.sha256()
+    size = 0
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MEMORY)
     try:
-        supabase.table("messages").insert({
-            "user_id": user_id,
-            "chat_id": chat_id,
-            "message_id": message_id
-        }).execute()
+        with TELEGRAM_HTTP.get(telegram_file_url(file_path), stream=True, timeout=UPLOAD_TIMEOUT) as src:
+            src.raise_for_status()
+            if int(src.headers.get("content-length") or 0) > MAX_UPLOAD_BYTES:
+                raise UploadTooLarge(file_path)
+            for chunk in src.iter_content(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise UploadTooLarge(file_path)
+                digest.update(chunk)
+                spool.write(chunk)
     except Exception:
-        pass
+        spool.close()
+        raise
+    spool.seek(0)
+    timings["download"] = time.monotonic() - started
+    timings["bytes"] = size
+    return spool, digest.hexdigest()
+
+class _UploadBody:
+    """Iterable request body with a known length.
+
+    requests sizes a plain file object through fileno(), which would make a
+    SpooledTemporaryFile roll over to disk; with __len__ it sends
+    Content-Length and iterates the chunks instead.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        start = fileobj.tell()
+        self.length = fileobj.seek(0, io.SEEK_END) - start
+        fileobj.seek(start)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            chunk = self.fileobj.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def stream_to_supabase(fileobj, bucket, object_path, content_type, timings):
+    """Upload a file object to Supabase storage (upsert), streamed in UPLOAD_CHUNK_SIZE blocks."""
+    object_path = object_path.lstrip("/")
+    started = time.monotonic()
+    resp = SUPABASE_HTTP.post(
+        f"{SUPABASE_URL}/storage/v1/object/{bucket}/{object_path}",
+        data=_UploadBody(fileobj),
+        headers={
+            "Authorization": f"Bearer {SUPABASE_KEY}",
+            "apikey": SUPABASE_KEY,
+            "Content-Type": content_type,
+            "x-upsert": "true",
+        },
+        timeout=UPLOAD_TIMEOUT,
+    )
+    resp.raise_for_status()
+    timings["upload"] = time.monotonic() - started
+    return object_path, supabase.storage.from_(bucket).get_public_url(object_path)
 
-def delete_old_messages(user_row):
+# -------------------------
+# Duplicate screenshot detection
+# -------------------------
+# Keys are (user_id, "file_unique_id" | "content_hash", value). Backed by the
+# payments.file_unique_id / payments.content_hash columns.
+PAYMENT_DEDUP_TTL = int(os.getenv("PAYMENT_DEDUP_TTL", str(7 * 24 * 3600)))
+PAYMENT_DEDUP_INDEX = TTLCache("payment_dedup", 50000, PAYMENT_DEDUP_TTL)
+
+def is_duplicate_payment(user_id, column, value):
+    """True if this user already has a payment with the same file_unique_id / content_hash."""
+    if not value:
+        return False
+    key = (user_id, column, value)
+    if PAYMENT_DEDUP_INDEX.get(key):
+        return True
     try:
-        rows = supabase.table("messages").select("*").eq("user_id", user_row["id"]).execute().data or []
-        for r in rows:
+        found = payments_repo.exists(user_id, column, value)
+    except Exception as e:
+        logger.warning("Duplicate check on payments.%s failed: %s", column, e)
+        return False
+    if found:
+        PAYMENT_DEDUP_INDEX.set(key, True)
+        return True
+    return False
+
+def remember_payment(user_id, file_unique_id, content_hash):
+    if file_unique_id:
+        PAYMENT_DEDUP_INDEX.set((user_id, "file_unique_id", file_unique_id), True)
+    if content_hash:
+        PAYMENT_DEDUP_INDEX.set((user_id, "content_hash", content_hash), True)
+
+@instrumented("create_payment")
+def create_payment(user_row, file_path, file_url, username, content_hash=None, file_unique_id=None):
+    payment_id = payments_repo.create(user_row.id, username, file_path, file_url, content_hash, file_unique_id)
+    remember_payment(user_row.id, file_unique_id, content_hash)
+    return payment_id
+
+class BulkWriter:
+    """Write-behind buffer that bulk-inserts rows via `insert_many(rows)`.
+
+    Rows are flushed as one insert when `flush_size` rows are pending or every
+    `flush_interval` seconds. Failed batches are retried a few times before
+    being dropped; `max_pending` bounds memory if the DB is unreachable.
+    """
+
+    MAX_FAILED_FLUSHES = 3
+
+    def __init__(self, table, insert_many, flush_size, flush_interval, max_pending):
+        self.table = table
+        self.insert_many = insert_many
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._failed_flushes = 0
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+        self.job_name = f"bulk-writer-{table}"
+        self._schedule()
+
+    def _schedule(self):
+        SCHEDULER.every(self.job_name, self.flush_interval, self.flush, jitter=0)
+
+    def _flush_soon(self):
+        SCHEDULER.trigger(self.job_name)
+
+    def add(self, row):
+        with self._lock:
+            self._rows.append(row)
+            self._trim()
+            full = len(self._rows) >= self.flush_size
+        if full:
+            self._flush_soon()
+
+    def _trim(self):
+        # caller holds self._lock
+        overflow = len(self._rows) - self.max_pending
+        if overflow > 0:
+            del self._rows[:overflow]
+            self.dropped += overflow
+
+    def _take(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+        return rows
+
+    def _flushed(self, rows, error=None):
+        """Account for one insert attempt: requeue or drop the rows on failure. Returns rows written."""
+        if error is not None:
+            self.failures += 1
+            self._failed_flushes += 1
+            if self._failed_flushes >= self.MAX_FAILED_FLUSHES:
+                logger.warning("Dropping %d %s rows after repeated insert failures: %s", len(rows), self.table, error)
+                self.dropped += len(rows)
+                self._failed_flushes = 0
+                return 0
+            logger.warning("Bulk insert into %s failed, will retry: %s", self.table, error)
+            with self._lock:
+                self._rows[:0] = rows
+                self._trim()
+            return 0
+        self._failed_flushes = 0
+        self.written += len(rows)
+        self.flushes += 1
+        return len(rows)
+
+    def flush(self):
+        """Insert everything pending now. Returns the number of rows written."""
+        with self._flush_lock:
+            rows = self._take()
+            if not rows:
+                return 0
             try:
-                bot.delete_message(r["chat_id"], r["message_id"])
-            except Exception:
-                pass
-        supabase.table("messages").delete().eq("user_id", user_row["id"]).execute()
-    except Exception:
-        pass
+                self.insert_many(rows)
+            except Exception as e:
+                return self._flushed(rows, e)
+            return self._flushed(rows)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._rows)
+        return {
+            "pending": pending,
+            "written": self.written,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "dropped": self.dropped,
+        }
+
+
+MESSAGE_FLUSH_SIZE = int(os.getenv("MESSAGE_FLUSH_SIZE", "50"))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "2"))  # seconds
+MESSAGE_BUFFER_MAX = int(os.getenv("MESSAGE_BUFFER_MAX", "10000"))
+MESSAGE_WRITER = BulkWriter("messages", messages_repo.insert_many, MESSAGE_FLUSH_SIZE, MESSAGE_FLUSH_INTERVAL, MESSAGE_BUFFER_MAX)
+atexit.register(MESSAGE_WRITER.flush)
+
+@instrumented("save_message")
+def save_message(user_id, chat_id, message_id):
+    """Record a sent message for later cleanup (buffered, never blocks on the DB)."""
+    MESSAGE_WRITER.add({
+        "user_id": user_id,
+        "chat_id": chat_id,
+        "message_id": message_id
+    })
+
+MESSAGE_DELETE_BATCH = 100  # deleteMessages accepts at most 100 ids per call
+MESSAGE_ROWS_DELETE_CHUNK = 200  # ids per DB delete, keeps the PostgREST URL short
+CLEANUP_QUEUE = queue.Queue()
+
+def _delete_chat_messages(chat_id, message_ids):
+    """Delete messages from one chat, returning the ids that were removed.
+
+    Goes through the outbox at bulk priority, which paces the calls and
+    waits out 429s.
+    """
+    removed = []
+    bulk_delete = hasattr(bot, "delete_messages")  # Bot API 7.0+
+    for i in range(0, len(message_ids), MESSAGE_DELETE_BATCH):
+        batch = message_ids[i:i + MESSAGE_DELETE_BATCH]
+        if bulk_delete:
+            try:
+                outbox.call("delete_messages", chat_id, batch, priority=PRIORITY_BULK)
+                removed.extend(batch)
+                continue
+            except Exception as e:
+                logger.info("Bulk delete failed in chat %s, deleting one by one: %s", chat_id, e)
+        for mid in batch:
+            try:
+                outbox.call("delete_message", chat_id, mid, priority=PRIORITY_BULK)
+                removed.append(mid)
+            except Exception as e:
+                logger.info("Could not delete message %s in chat %s: %s", mid, chat_id, e)
+    return removed
+
+def group_messages_by_chat(pairs, keep_message_ids=()):
+    """(chat_id, message_id) pairs -> {chat_id: [message_id, ...]}, leaving out the kept ids."""
+    by_chat = {}
+    for chat_id, message_id in pairs:
+        if message_id not in keep_message_ids:
+            by_chat.setdefault(chat_id, []).append(message_id)
+    return by_chat
+
+def delete_old_messages(user_row, keep_message_ids=()):
+    """Delete the user's saved bot messages from Telegram, then their DB rows.
+
+    Only rows for messages that were actually deleted are removed.
+    """
+    try:
+        # make sure buffered rows for this user are in the table first
+        MESSAGE_WRITER.flush()
+        by_chat = group_messages_by_chat(messages_repo.list_for_user(user_row.id), keep_message_ids)
+        for chat_id, message_ids in by_chat.items():
+            removed = _delete_chat_messages(chat_id, message_ids)
+            for i in range(0, len(removed), MESSAGE_ROWS_DELETE_CHUNK):
+                messages_repo.delete(user_row.id, chat_id, removed[i:i + MESSAGE_ROWS_DELETE_CHUNK])
+    except Exception as e:
+        logger.warning("Message cleanup failed for user %s: %s", user_row.id, e)
+
+def _cleanup_worker():
+    # a single worker keeps cleanup serial so it never floods the outbox
+    while True:
+        user_row, keep_message_ids = CLEANUP_QUEUE.get()
+        try:
+            delete_old_messages(user_row, keep_message_ids)
+        finally:
+            CLEANUP_QUEUE.task_done()
+
+def schedule_message_cleanup(user_row, keep_message_ids=()):
+    start_background_thread("message-cleanup", _cleanup_worker)
+    CLEANUP_QUEUE.put((user_row, set(keep_message_ids)))
 
 def notify_user_upgrade(user_row):
+    keep = []
     try:
-        delete_old_messages(user_row)
-        sent = bot.send_message(
-            user_row["telegram_id"],
-            "💲 We upgraded you to Premium User!\n\nClick /start to access your courses 🚀",
-            parse_mode="Markdown"
-        )
-        save_message(user_row["id"], user_row["telegram_id"], sent.message_id)
+        sent = outbox.send_message(user_row.telegram_id, UPGRADE_NOTICE, parse_mode="Markdown")
+        keep.append(sent.message_id)
+        save_message(user_row.id, user_row.telegram_id, sent.message_id)
         # Invalidate cache so /start shows premium menu next time
-        invalidate_user_cache(user_row["telegram_id"])
+        invalidate_user_cache(user_row.telegram_id)
     except Exception:
         pass
+    # old messages are removed in the background, after the user has been told
+    schedule_message_cleanup(user_row, keep)
 
 # -------------------------
-# Premium Menu Keyboards
+# Course catalog (courses.json, hot-reloaded)
 # -------------------------
-def main_menu_keyboard():
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
-    markup.add(
-        "🔹 Programming Courses",
-        "🔹 Hacking & Cybersecurity Courses",
-        "🔹 System & OS Courses",
-        "🔹 Special Cyber Tools Courses",
-    )
-    return markup
-
-def programming_courses_keyboard():
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    markup.add("💻 C++", "☕️ Java", "🌐 JavaScript", "🐍 Python", "⬅ Back")
-    return markup
-
-def hacking_courses_keyboard():
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    markup.add(
-        "🎩 BlackHat Hacking", "🛡 Ethical Hacking", "🤖 Android Hacking", "📶 WiFi Hacking",
-        "🗑 Binning (by BlackHat)", "🎭 Phishing App Development",
-        "🎮 PUBG Hack Development", "📱 APK Modding (20+ Courses)", "⬅ Back"
-    )
-    return markup
-
-def system_os_courses_keyboard():
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    markup.add("🐧 Linux", "⚡️ PowerShell", "⬅ Back")
-    return markup
-
-
-def special_tools_courses_keyboard():
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    markup.add(
-        "📞 Make a Telegram Number",
-        "💻 Lifetime RDP",
-        "☎️  Call Any Indian Number Free",
-        "💣 Own SMS Bomber",
-        "✉️ Own Temporary Mail Bot",
-        "⬅ Back"
-    )
-    return markup
+COURSE_CATALOG_PATH = os.getenv(
+    "COURSE_CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "courses.json")
+)
+COURSE_CATALOG_CHECK_INTERVAL = float(os.getenv("COURSE_CATALOG_CHECK_INTERVAL", "30"))  # seconds
+COURSE_UNAVAILABLE_REPLY = ("⚠️ This course is not available yet.", None)
+
+def _reply_keyboard_json(buttons, row_width):
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=row_width)
+    markup.add(*buttons)
+    return markup.to_json()
+
+class CourseCatalog:
+    """One version of the course catalog with every reply prebuilt.
+
+    `menu` maps button text -> (reply text, reply_markup JSON or None); telebot
+    sends a str reply_markup as-is. Instances are never mutated: a reload
+    builds a new one and swaps the module-level reference.
+    """
+
+    def __init__(self, data, mtime=None):
+        self.version = data.get("version")
+        self.mtime = mtime
+        self.categories = data["categories"]
+        self.courses = {c["button"]: c for cat in self.categories for c in cat["courses"]}
+        self.overview_message = data["overview_title"] + "\n\n" + "\n\n".join(
+            f"🔹 *{cat['title']}*\n" + "\n".join(c["title"] for c in cat["courses"])
+            for cat in self.categories
+        )
+        self.main_menu_markup = _reply_keyboard_json([cat["button"] for cat in self.categories], 1)
+
+        back = data.get("back_button", "⬅ Back")
+        select_text = data.get("select_text", "Select a course:")
+        self.menu = {back: (data.get("main_menu_text", "Main Menu:"), self.main_menu_markup)}
+        for cat in self.categories:
+            buttons = [c["button"] for c in cat["courses"]] + [back]
+            self.menu[cat["button"]] = (select_text, _reply_keyboard_json(buttons, cat.get("row_width", 2)))
+        for button, course in self.courses.items():
+            self.menu[button] = (f"{course['description']}\n\n🔗 Download: {course['link']}", None)
+
+def load_course_catalog(path=COURSE_CATALOG_PATH):
+    mtime = os.path.getmtime(path)
+    with open(path, encoding="utf-8") as f:
+        return CourseCatalog(json.load(f), mtime)
+
+COURSE_CATALOG = load_course_catalog()
+_catalog_checked_at = time.monotonic()
+_catalog_reload_lock = threading.Lock()
+
+def current_catalog():
+    """Return the live catalog, reloading it first if courses.json changed.
+
+    The mtime is checked at most every COURSE_CATALOG_CHECK_INTERVAL seconds;
+    a file that fails to load leaves the current version in place.
+    """
+    global COURSE_CATALOG, _catalog_checked_at
+    now = time.monotonic()
+    if now - _catalog_checked_at < COURSE_CATALOG_CHECK_INTERVAL:
+        return COURSE_CATALOG
+    if not _catalog_reload_lock.acquire(blocking=False):
+        return COURSE_CATALOG
+    try:
+        _catalog_checked_at = now
+        if os.path.getmtime(COURSE_CATALOG_PATH) != COURSE_CATALOG.mtime:
+            COURSE_CATALOG = load_course_catalog()
+            logger.info("Reloaded course catalog (version %s)", COURSE_CATALOG.version)
+    except Exception as e:
+        logger.warning("Course catalog reload failed, keeping version %s: %s", COURSE_CATALOG.version, e)
+    finally:
+        _catalog_reload_lock.release()
+    return COURSE_CATALOG
 
 # -------------------------
 # /start handler
@@ -302,11 +2030,11 @@ def send_welcome(message):
     )
 
     # premium users: same as before
-    if user and user.get("status") == "premium":
-        bot.send_message(
+    if user and user.is_premium:
+        outbox.send_message(
             cid,
             "🎉 Welcome back Premium User!",
-            reply_markup=main_menu_keyboard()
+            reply_markup=current_catalog().main_menu_markup
         )
         return
 
@@ -318,40 +2046,25 @@ def send_welcome(message):
 
     if joined:
         # Show courses + promo as before
-        sent = bot.send_message(cid, COURSES_MESSAGE, parse_mode="Markdown")
+        sent = outbox.send_message(cid, current_catalog().overview_message, parse_mode="Markdown")
         try:
-            save_message(user["id"], cid, sent.message_id)
+            save_message(user.id, cid, sent.message_id)
         except Exception:
             pass
 
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("Buy Course For ₹79", callback_data="buy"))
-        sent2 = bot.send_message(cid, PROMO_MESSAGE, parse_mode="Markdown", reply_markup=markup)
+        sent2 = outbox.send_message(cid, PROMO_MESSAGE, parse_mode="Markdown", reply_markup=BUY_MARKUP)
         try:
-            save_message(user["id"], cid, sent2.message_id)
+            save_message(user.id, cid, sent2.message_id)
         except Exception:
             pass
         return
     else:
         # Not joined -> show Join + Try Again buttons
-        kb = types.InlineKeyboardMarkup()
-        # join button uses URL
-        kb.add(types.InlineKeyboardButton("🔗 Join Channel", url=CHANNEL_URL))
-        # try again callback to re-check membership
-        kb.add(types.InlineKeyboardButton("✅ Try Again", callback_data="check_join"))
-
-        sent_msg = bot.send_message(
-            cid,
-            f"💬 *Please join our Telegram channel first to access courses.*\n\n"
-            f"Channel: {CHANNEL_USERNAME}\n\n"
-            "Click *Join Channel* then come back and press *Try Again*.",
-            parse_mode="Markdown",
-            reply_markup=kb
-        )
+        sent_msg = outbox.send_message(cid, JOIN_PROMPT, parse_mode="Markdown", reply_markup=JOIN_MARKUP)
         try:
             # save for possible cleanup
             if user:
-                save_message(user["id"], cid, sent_msg.message_id)
+                save_message(user.id, cid, sent_msg.message_id)
         except Exception:
             pass
         return
@@ -367,29 +2080,24 @@ def handle_buy(call):
         pass
 
     cid = call.message.chat.id
-    instr_markup = types.InlineKeyboardMarkup()
-    instr_markup.add(types.InlineKeyboardButton("I Paid (Upload Screenshot)", callback_data="i_paid"))
-
-    caption = f"{PAYMENT_INSTRUCTIONS}\n\n👇 After payment, click the button below."
-
     try:
-        sent = bot.send_photo(
+        sent = outbox.send_photo(
             cid,
             QR_IMAGE_URL + datetime.utcnow().strftime("%H%M%S"),
-            caption=caption,
+            caption=QR_CAPTION,
             parse_mode="Markdown",
-            reply_markup=instr_markup
+            reply_markup=PAID_MARKUP
         )
         # Save message for deletion later if user exists
-        user = get_user_cached(call.from_user.id) or supabase.table("users").select("*").eq("telegram_id", call.from_user.id).single().execute().data
+        user = get_user_cached(call.from_user.id)
         if user:
             try:
-                save_message(user["id"], cid, sent.message_id)
+                save_message(user.id, cid, sent.message_id)
             except Exception:
                 pass
     except Exception as e:
         try:
-            bot.send_message(cid, "❌ Failed to send QR image. Please try again.")
+            outbox.send_message(cid, "❌ Failed to send QR image. Please try again.")
         except Exception:
             pass
         logger.exception("handle_buy error: %s", e)
@@ -403,15 +2111,15 @@ def handle_paid(call):
 
     cid = call.message.chat.id
     try:
-        supabase.table("users").update({"pending_upload": True}).eq("telegram_id", call.from_user.id).execute()
+        users_repo.set_pending_upload(call.from_user.id, True)
     except Exception:
         pass
 
-    sent = bot.send_message(cid, "✅ Please upload your payment screenshot here.\n\nMake sure the screenshot clearly shows the transaction details.")
+    sent = outbox.send_message(cid, UPLOAD_PROMPT)
     try:
-        user = get_user_cached(call.from_user.id) or supabase.table("users").select("*").eq("telegram_id", call.from_user.id).single().execute().data
+        user = get_user_cached(call.from_user.id)
         if user:
-            save_message(user["id"], cid, sent.message_id)
+            save_message(user.id, cid, sent.message_id)
     except Exception:
         pass
     
@@ -434,48 +2142,59 @@ def handle_check_join(call):
     if is_member_of_channel(uid):
         # user joined — send the regular non-premium start flow
         try:
-            sent = bot.send_message(cid, COURSES_MESSAGE, parse_mode="Markdown")
-            user = get_user_cached(uid) or supabase.table("users").select("*").eq("telegram_id", uid).single().execute().data
+            sent = outbox.send_message(cid, current_catalog().overview_message, parse_mode="Markdown")
+            user = get_user_cached(uid)
             if user:
                 try:
-                    save_message(user["id"], cid, sent.message_id)
+                    save_message(user.id, cid, sent.message_id)
                 except Exception:
                     pass
 
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("Buy Course For ₹79", callback_data="buy"))
-            sent2 = bot.send_message(cid, PROMO_MESSAGE, parse_mode="Markdown", reply_markup=markup)
+            sent2 = outbox.send_message(cid, PROMO_MESSAGE, parse_mode="Markdown", reply_markup=BUY_MARKUP)
             if user:
                 try:
-                    save_message(user["id"], cid, sent2.message_id)
+                    save_message(user.id, cid, sent2.message_id)
                 except Exception:
                     pass
         except Exception as e:
             logger.exception("Error sending courses after successful join: %s", e)
             try:
-                bot.send_message(cid, "✅ You are a channel member — but I couldn't send the content right now. Try again later.")
+                outbox.send_message(cid, "✅ You are a channel member — but I couldn't send the content right now. Try again later.")
             except Exception:
                 pass
     else:
         # still not a member
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("🔗 Join Channel", url=CHANNEL_URL))
-        kb.add(types.InlineKeyboardButton("✅ Try Again", callback_data="check_join"))
         try:
-            bot.send_message(
-                cid,
-                f"💬 You still need to join {CHANNEL_USERNAME} before continuing.\n\n"
-                f"Click *Join Channel* and then *Try Again*.",
-                parse_mode="Markdown",
-                reply_markup=kb
-            )
+            outbox.send_message(cid, JOIN_REMINDER, parse_mode="Markdown", reply_markup=JOIN_MARKUP)
         except Exception:
             pass
 
+# -------------------------
+# Channel membership updates (keeps MEMBER_CACHE current)
+# -------------------------
+def _is_join_channel(chat) -> bool:
+    if CHANNEL_USERNAME.startswith("@"):
+        return (getattr(chat, "username", None) or "").lower() == CHANNEL_USERNAME.lstrip("@").lower()
+    return str(chat.id) == CHANNEL_USERNAME
+
+@bot.chat_member_handler()
+def handle_channel_member_update(update):
+    """Telegram reports joins/leaves of CHANNEL_USERNAME here (bot must be a channel admin)."""
+    if not _is_join_channel(update.chat):
+        return
+    member = update.new_chat_member
+    record_channel_membership(member.user.id, member.status not in ("left", "kicked"), broadcast=True)
 
 # -------------------------
 # Upload handler (photo/document)
 # -------------------------
+def _acknowledge_duplicate_upload(message, user):
+    try:
+        users_repo.set_pending_upload(user.id, False)
+    except Exception:
+        pass
+    outbox.reply_to(message, UPLOAD_DUPLICATE)
+
 @bot.message_handler(content_types=["photo", "document"])
 def handle_upload(message):
     user = message.from_user
@@ -484,155 +2203,296 @@ def handle_upload(message):
     except Exception:
         t_id = user.id
 
-    try:
-        uresp = supabase.table("users").select("*").eq("telegram_id", t_id).single().execute()
-        urow = uresp.data
-    except Exception:
-        urow = None
+    # the replica sees handle_paid's write-through; confirm with the DB before rejecting
+    urow = replica_get_user(t_id)
+    if not urow or not urow.pending_upload:
+        try:
+            urow = users_repo.get_by_telegram_id(t_id)
+        except Exception:
+            urow = None
 
-    if not urow or not urow.get("pending_upload"):
-        bot.reply_to(message, "⚠️ Please click *I Paid (Upload Screenshot)* before sending a screenshot.", parse_mode="Markdown")
+    if not urow or not urow.pending_upload:
+        outbox.reply_to(message, UPLOAD_NOT_REQUESTED, parse_mode="Markdown")
         return
 
-    try:
-        fid = message.photo[-1].file_id if message.content_type == "photo" else message.document.file_id
-        file_info = bot.get_file(fid)
-        file_bytes = bot.download_file(file_info.file_path)
-    except Exception:
-        bot.reply_to(message, "❌ Failed to download your screenshot. Please try again.")
+    if message.content_type == "photo":
+        media, content_type = message.photo[-1], "image/jpeg"
+    else:
+        media, content_type = message.document, message.document.mime_type or "application/octet-stream"
+    if (media.file_size or 0) > MAX_UPLOAD_BYTES:
+        outbox.reply_to(message, UPLOAD_TOO_LARGE)
         return
 
-    ts = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
-    ext = os.path.splitext(file_info.file_path)[1] or ".jpg"
-    object_path = f"{UPLOAD_FOLDER_PREFIX}/{user.id}_{ts}{ext}"
+    # same Telegram file again: acknowledge without downloading anything
+    if is_duplicate_payment(urow.id, "file_unique_id", media.file_unique_id):
+        _acknowledge_duplicate_upload(message, user)
+        return
 
+    timings = {}
+    spool = None
     try:
-        _, url = upload_to_supabase(BUCKET_NAME, object_path, file_bytes)
-    except Exception as e:
-        bot.reply_to(message, f"❌ Upload failed. Error: {e}")
+        file_info = bot.get_file(media.file_id)
+        if UPLOAD_STREAMING:
+            spool, content_hash = download_to_spool(file_info.file_path, timings)
+        else:
+            t = time.monotonic()
+            file_bytes = bot.download_file(file_info.file_path)
+            timings["download"] = time.monotonic() - t
+            content_hash = hashlib.sha256(file_bytes).hexdigest()
+    except UploadTooLarge:
+        outbox.reply_to(message, UPLOAD_TOO_LARGE)
+        return
+    except Exception:
+        outbox.reply_to(message, "❌ Failed to download your screenshot. Please try again.")
         return
 
     try:
-        create_payment(urow, object_path, url, user.username or "")
+        # same image re-sent or forwarded (new file_unique_id, same bytes)
+        if is_duplicate_payment(urow.id, "content_hash", content_hash):
+            _acknowledge_duplicate_upload(message, user)
+            return
+
+        ts = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        ext = os.path.splitext(file_info.file_path)[1] or ".jpg"
+        object_path = f"{UPLOAD_FOLDER_PREFIX}/{user.id}_{ts}{ext}"
+
+        try:
+            if UPLOAD_STREAMING:
+                _, url = stream_to_supabase(spool, BUCKET_NAME, object_path, content_type, timings)
+            else:
+                t = time.monotonic()
+                _, url = upload_to_supabase(BUCKET_NAME, object_path, file_bytes, content_type)
+                timings["upload"] = time.monotonic() - t
+        except Exception as e:
+            outbox.reply_to(message, f"❌ Upload failed. Error: {e}")
+            return
+    finally:
+        if spool is not None:
+            spool.close()
+
+    try:
+        t = time.monotonic()
+        create_payment(urow, object_path, url, user.username or "", content_hash, media.file_unique_id)
+        timings["db_insert"] = time.monotonic() - t
     except Exception:
-        bot.reply_to(message, "❌ Failed to record your payment. Please try again.")
+        outbox.reply_to(message, "❌ Failed to record your payment. Please try again.")
         return
+    logger.info(
+        "Upload for user %s: download=%.3fs upload=%.3fs db_insert=%.3fs",
+        user.id, timings.get("download", 0.0), timings.get("upload", 0.0), timings["db_insert"],
+    )
 
     try:
-        supabase.table("users").update({"pending_upload": False}).eq("telegram_id", user.id).execute()
+        users_repo.set_pending_upload(user.id, False)
     except Exception:
         pass
 
-    bot.send_message(
-        message.chat.id,
-        "❤️‍🔥 Payment screenshot received!\n\n"
-        "Admin will verify your payment shortly. If approved, you'll be upgraded to Premium. 🚀",
-        parse_mode="Markdown"
-    )
-    notify_admins(f"🆕 Payment uploaded by @{user.username or user.id}\nUserID: {urow.get('id')}\nURL: {url}")
+    outbox.send_message(message.chat.id, UPLOAD_RECEIVED, parse_mode="Markdown")
+    notify_admins(payment_notice(user, urow.id, url))
 
 # -------------------------
 # /admin and admin helpers
 # -------------------------
+ADMIN_HELP = (
+    "👮 *Admin Commands*\n\n"
+    "/upgrade <userid|username> – Upgrade manually\n"
+    "/allpremiumuser – View all Premium users\n"
+    "/profile [seconds] – Sample stacks, get a flamegraph file\n"
+    "/trace [rate|update_id] – Set trace sampling or show a trace"
+)
+
 @bot.message_handler(commands=["admin"])
 def admin_help(message):
     if not is_admin(message.from_user.id):
         return
-    bot.reply_to(message, (
-        "👮 *Admin Commands*\n\n"
-        "/upgrade <userid|username> – Upgrade manually\n"
-        "/allpremiumuser – View all Premium users"
-    ), parse_mode="Markdown")
+    outbox.reply_to(message, ADMIN_HELP, parse_mode="Markdown")
+
+# /profile and /trace: parsing and replies shared with async_main
+def profile_seconds(text):
+    """Seconds asked for by `/profile [seconds]`, capped at PROFILE_MAX_SECONDS; None if unusable."""
+    parts = text.split()
+    try:
+        seconds = float(parts[1]) if len(parts) > 1 else 10.0
+    except ValueError:
+        return None
+    return min(seconds, PROFILE_MAX_SECONDS) if seconds > 0 else None
+
+def profile_document(folded, seconds):
+    """(file, caption) for sending a finished profile as a document."""
+    dump = io.BytesIO(folded.encode("utf-8"))
+    dump.name = f"profile-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.folded"
+    return dump, f"🔥 {seconds:g}s profile (collapsed stacks, for flamegraph.pl / speedscope)"
+
+def trace_command(text):
+    """Reply to `/trace [rate 0..1 | update_id]`: set the sampling rate, or render one kept trace."""
+    parts = text.split()
+    if len(parts) > 1:
+        try:
+            value = float(parts[1])
+        except ValueError:
+            value = -1.0
+        if not value >= 0:
+            return "Usage: /trace [rate 0..1 | update_id]"
+        if value > 1:
+            with _TRACES_LOCK:
+                trace = TRACES.get(int(value))
+            if trace is None:
+                return "No trace kept for that update."
+            return "\n".join(render_trace_text(trace.to_dict()["root"]))[:4000]
+        TRACE_STATE["rate"] = value
+    with _TRACES_LOCK:
+        recent = [t.summary() for t in list(TRACES.values())[-5:]]
+    lines = [f"Trace sampling: {TRACE_STATE['rate']:g}"]
+    lines += [f"{t['update_id']}  {t['handler']}  {t['duration_ms']}ms" for t in reversed(recent)]
+    return "\n".join(lines)
+
+def _send_profile(chat_id, seconds):
+    try:
+        folded = PROFILER.run(seconds)
+    except RuntimeError as e:
+        outbox.send_message(chat_id, f"❌ {e}")
+        return
+    dump, caption = profile_document(folded, seconds)
+    outbox.send_document(chat_id, dump, caption=caption, priority=PRIORITY_ADMIN)
+
+@bot.message_handler(commands=["profile"])
+def admin_profile(message):
+    if not is_admin(message.from_user.id):
+        return
+    seconds = profile_seconds(message.text)
+    if seconds is None:
+        outbox.reply_to(message, "Usage: /profile [seconds]")
+        return
+    outbox.reply_to(message, f"⏱ Profiling for {seconds:g}s…")
+    threading.Thread(target=_send_profile, args=(message.chat.id, seconds), name="profiler", daemon=True).start()
+
+@bot.message_handler(commands=["trace"])
+def admin_trace(message):
+    if not is_admin(message.from_user.id):
+        return
+    outbox.reply_to(message, trace_command(message.text))
+
+PREMIUM_PAGE_SIZE = int(os.getenv("PREMIUM_PAGE_SIZE", "20"))
+PREMIUM_COUNT_TTL = int(os.getenv("PREMIUM_COUNT_TTL", "300"))  # seconds
+COUNTERS = TTLCache("counters", 32, PREMIUM_COUNT_TTL)
+on_bus_message("counter", COUNTERS.invalidate)
+
+def premium_user_count():
+    """Exact number of premium users, cached for PREMIUM_COUNT_TTL (None if unavailable)."""
+    count = COUNTERS.get("premium_users")
+    if count is not None:
+        return count
+    try:
+        count = users_repo.count_premium()
+    except Exception as e:
+        logger.warning("Premium user count failed: %s", e)
+        return None
+    if count is not None:
+        COUNTERS.set("premium_users", count)
+    return count
+
+def fetch_premium_page(after_id=None, before_id=None):
+    """Return (rows, has_prev, has_next) for one page of premium users ordered by id.
+
+    Keyset pagination: pages are addressed by the id just outside them, so the
+    cost doesn't grow with how far the admin has paged.
+    """
+    if before_id is not None:
+        rows = users_repo.list_premium(before_id=before_id, limit=PREMIUM_PAGE_SIZE + 1)
+        has_prev = len(rows) > PREMIUM_PAGE_SIZE
+        return list(reversed(rows[:PREMIUM_PAGE_SIZE])), has_prev, True
+    rows = users_repo.list_premium(after_id=after_id, limit=PREMIUM_PAGE_SIZE + 1)
+    has_next = len(rows) > PREMIUM_PAGE_SIZE
+    return rows[:PREMIUM_PAGE_SIZE], after_id is not None, has_next
+
+def render_premium_page(rows, has_prev, has_next, total=None):
+    header = "💎 *Premium Users*" + (f" ({total} total)" if total is not None else "") + ":\n\n"
+    lines = []
+    for u in rows:
+        lines.append(
+            "ID: {id}\nTelegramID: {telegram_id}\nUsername: @{username}\nName: {first} {last}\nStatus: {status}\nCreated: {created}\n\n".format(
+                id=u.get("id"),
+                telegram_id=u.get("telegram_id"),
+                username=u.get("username") or "N/A",
+                first=u.get("first_name") or "",
+                last=u.get("last_name") or "",
+                status=u.get("status"),
+                created=u.get("created_at")
+            )
+        )
+    markup = types.InlineKeyboardMarkup()
+    nav = []
+    if has_prev:
+        nav.append(types.InlineKeyboardButton("⬅ Prev", callback_data=f"prem:p:{rows[0]['id']}"))
+    if has_next:
+        nav.append(types.InlineKeyboardButton("Next ➡", callback_data=f"prem:n:{rows[-1]['id']}"))
+    if nav:
+        markup.row(*nav)
+    return header + "".join(lines), markup
 
 @bot.message_handler(commands=["allpremiumuser"])
 def admin_allpremiumuser(message):
     # ensure the caller is admin
     if not is_admin(message.from_user.id):
-        bot.reply_to(message, "❌ You are not an admin.")
+        outbox.reply_to(message, "❌ You are not an admin.")
         logger.warning("Unauthorized /allpremiumuser call from %s", message.from_user.id)
         return
 
     try:
-        # Use ilike for case-insensitive match (handles 'Premium', 'premium', etc.)
-        # NOTE: .ilike is supported by the supabase-py client interface.
-        resp = supabase.table("users").select("*").ilike("status", "premium").execute()
+        rows, has_prev, has_next = fetch_premium_page()
     except Exception as e:
         logger.exception("Supabase query failed in /allpremiumuser: %s", e)
-        bot.reply_to(message, "❌ Database error while fetching premium users (see logs).")
+        outbox.reply_to(message, "❌ Database error while fetching premium users (see logs).")
         return
 
-    # debug log the raw response object for troubleshooting
-    logger.info("/allpremiumuser supabase raw resp: %r", resp)
-
-    # Try to extract rows in multiple possible shapes
-    rows = None
-    try:
-        # typical supabase-py response has .data
-        rows = getattr(resp, "data", None)
-    except Exception:
-        rows = None
-
-    # Some client versions return a dict
-    if rows is None and isinstance(resp, dict) and "data" in resp:
-        rows = resp["data"]
-
-    # Some older clients return list directly
-    if rows is None and isinstance(resp, (list, tuple)):
-        rows = resp
-
     if not rows:
         # helpful hint for operators
         hint = (
             "No premium users returned.\n"
             "- If you expect rows, check Supabase table data and 'status' column values.\n"
-            "- If Row Level Security is enabled, ensure your server key has permission.\n"
-            "- Check server logs for the Supabase response above."
+            "- If Row Level Security is enabled, ensure your server key has permission."
         )
-        bot.reply_to(message, f"❌ No Premium users found.\n\n{hint}")
+        outbox.reply_to(message, f"❌ No Premium users found.\n\n{hint}")
         return
 
-    # Build reply with safe chunking (Telegram max ~4096 chars)
-    header = "💎 *Premium Users:*\n\n"
-    lines = []
-    for u in rows:
+    text, markup = render_premium_page(rows, has_prev, has_next, premium_user_count())
+    try:
+        outbox.reply_to(message, text, parse_mode="Markdown", reply_markup=markup)
+    except Exception:
+        # fallback: send without markdown (usernames with '_' break it)
         try:
-            lines.append(
-                "ID: {id}\nTelegramID: {telegram_id}\nUsername: @{username}\nName: {first} {last}\nStatus: {status}\nCreated: {created}\n\n".format(
-                    id=u.get("id"),
-                    telegram_id=u.get("telegram_id"),
-                    username=u.get("username") or "N/A",
-                    first=u.get("first_name", ""),
-                    last=u.get("last_name", ""),
-                    status=u.get("status"),
-                    created=u.get("created_at")
-                )
-            )
+            outbox.reply_to(message, text, reply_markup=markup)
         except Exception:
-            # fallback for unexpected row shape
-            lines.append(str(u) + "\n\n")
-
-    # chunk message into pieces under 3500 chars to be safe
-    chunks = []
-    current = header
-    for l in lines:
-        if len(current) + len(l) > 3500:
-            chunks.append(current)
-            current = l
-        else:
-            current += l
-    if current:
-        chunks.append(current)
+            logger.exception("Failed to send /allpremiumuser page")
 
-    # send chunks
-    for c in chunks:
+@bot.callback_query_handler(func=lambda c: c.data.startswith("prem:"))
+def handle_premium_page(call):
+    if not is_admin(call.from_user.id):
+        return
+    try:
+        bot.answer_callback_query(call.id)
+    except Exception:
+        pass
+    try:
+        _, direction, anchor = call.data.split(":")
+        if direction == "n":
+            rows, has_prev, has_next = fetch_premium_page(after_id=int(anchor))
+        else:
+            rows, has_prev, has_next = fetch_premium_page(before_id=int(anchor))
+    except Exception as e:
+        logger.exception("Premium page fetch failed: %s", e)
+        return
+    if not rows:
+        return
+    text, markup = render_premium_page(rows, has_prev, has_next, premium_user_count())
+    edit = dict(chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=markup)
+    try:
+        outbox.call("edit_message_text", text, parse_mode="Markdown", **edit)
+    except Exception:
         try:
-            bot.reply_to(message, c, parse_mode="Markdown")
+            outbox.call("edit_message_text", text, **edit)
         except Exception:
-            # fallback: send without markdown
-            try:
-                bot.reply_to(message, c)
-            except Exception:
-                logger.exception("Failed to send /allpremiumuser chunk")
+            logger.exception("Failed to show premium users page")
 
 @bot.message_handler(commands=["upgrade"])
 def admin_upgrade(message):
@@ -641,39 +2501,39 @@ def admin_upgrade(message):
 
     args = message.text.split()
     if len(args) < 2:
-        bot.reply_to(message, "Usage: /upgrade <user_id|username>")
+        outbox.reply_to(message, "Usage: /upgrade <user_id|username>")
         return
     target = args[1]
 
     try:
         if target.isdigit():
-            resp = supabase.table("users").select("*").eq("id", int(target)).limit(1).execute()
+            user_row = users_repo.get_by_id(int(target))
         else:
-            username_lookup = target.lstrip("@")
-            resp = supabase.table("users").select("*").eq("username", username_lookup).limit(1).execute()
+            user_row = users_repo.get_by_username(target.lstrip("@"))
     except Exception:
-        bot.reply_to(message, "❌ Database error while searching for user.")
+        outbox.reply_to(message, "❌ Database error while searching for user.")
         return
 
-    user_row = (resp.data or [None])[0]
     if not user_row:
-        bot.reply_to(message, f"❌ User {target} not found.")
+        outbox.reply_to(message, f"❌ User {target} not found.")
         return
 
-    if user_row.get("status") == "premium":
-        bot.reply_to(message, f"✅ User {target} is already Premium.")
+    if user_row.is_premium:
+        outbox.reply_to(message, f"✅ User {target} is already Premium.")
         return
 
     try:
-        supabase.table("users").update({"status": "premium", "updated_at": datetime.utcnow().isoformat()}).eq("id", user_row["id"]).execute()
-        supabase.table("payments").update({"verified": True}).eq("user_id", user_row["id"]).execute()
-        invalidate_user_cache(user_row["telegram_id"])
+        users_repo.set_premium(user_row.id)
+        payments_repo.mark_verified(user_row.id)
+        invalidate_user_cache(user_row.telegram_id)
+        publish_invalidation("premium", user_row.telegram_id)
+        publish_invalidation("counter", "premium_users")
     except Exception:
-        bot.reply_to(message, f"❌ Failed to upgrade {target}.")
+        outbox.reply_to(message, f"❌ Failed to upgrade {target}.")
         return
 
     notify_user_upgrade(user_row)
-    bot.reply_to(message, f"✅ User {target} upgraded to Premium!")
+    outbox.reply_to(message, f"✅ User {target} upgraded to Premium!")
 
 # -------------------------
 # -------------------------
@@ -684,343 +2544,184 @@ def handle_menu(message):
     text = message.text
     chat_id = message.chat.id
 
-    user_row = get_user_cached(message.from_user.id)
-    if not user_row:
-        try:
-            uresp = supabase.table("users").select("*").eq("telegram_id", message.from_user.id).single().execute()
-            user_row = uresp.data
-            if user_row:
-                USER_CACHE[message.from_user.id] = (user_row.get("status"), time.time()+USER_CACHE_TTL, user_row)
-        except Exception:
-            user_row = None
-
-    if not user_row or user_row.get("status") != "premium":
+    if not is_premium_user(message.from_user.id):
         return
 
-    if text == "🔹 Programming Courses":
-        bot.send_message(chat_id, "Select a course:", reply_markup=programming_courses_keyboard())
-    elif text == "🔹 Hacking & Cybersecurity Courses":
-        bot.send_message(chat_id, "Select a course:", reply_markup=hacking_courses_keyboard())
-    elif text == "🔹 System & OS Courses":
-        bot.send_message(chat_id, "Select a course:", reply_markup=system_os_courses_keyboard())
-    elif text == "🔹 Special Cyber Tools Courses":
-        bot.send_message(chat_id, "Select a course:", reply_markup=special_tools_courses_keyboard())
-    elif text == "⬅ Back":
-        bot.send_message(chat_id, "Main Menu:", reply_markup=main_menu_keyboard())
-    else:
-        course = COURSE_DATA.get(text)
-        if course:
-            msg = f"{course['description']}\n\n🔗 Download: {course['link']}"
-            bot.send_message(chat_id, msg)
-        else:
-            bot.send_message(chat_id, "⚠️ This course is not available yet.")
+    reply_text, reply_markup = current_catalog().menu.get(text, COURSE_UNAVAILABLE_REPLY)
+    outbox.send_message(chat_id, reply_text, reply_markup=reply_markup)
+
+instrument_handlers(bot)  # every handler is registered above this line
 
 # -------------------------
-# External Course Hosting Map
+# Update de-duplication
 # -------------------------
-COURSE_DATA = {
-    "💻 C++": {
-        "description": (
-            "👩‍💻 C++ Programming for Beginners - From Beginner to Beyond 👩‍💻\n\n"
-            "🥵 What you'll learn​:-) \n\n"
-            "🚩 Learn to program with one of the most powerful programming languages that exists today, C++.\n\n"
-            "🚩 Obtain the key concepts of programming that will also apply to other programming languages.\n\n"
-            "🚩 Learn Modern C++ rather than an obsolete version of C++ that most other courses teach.\n\n"
-            "🚩 Learn C++ features from basic to more advanced such as inheritance and polymorphic functions.\n\n"
-            "🚩 Learn C++ using a proven curriculum that covers more material than most C++ university courses.\n\n"
-            "🚩 Learn C++ from an experienced university full professor who has been using and teaching C++ for more than 25 years.\n\n"
-            "🚩 Includes Quizzes, Live Coding Exercises, Challenge Coding Exercises and Assignments.\n\n"
-            "👥 Size:-) 2.44 GB\n"
-            "⏳ Time:-) 31:07:29\n"
-                         "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-
-        ),
-        "link": "https://drive.google.com/file/d/1Ur5T9dGb_e5EBNJzpTg08ieSHKxwBoeQ/view"
-    },
-    "☕️ Java": {
-   "description": (
-        "🚀 Master Java Programming Today! 👨‍💻\n\n"
-        "📘 Exclusive JAVA Learning PDFs\n"
-        "Level up your coding skills with these high-quality resources – perfect for beginners to advanced learners.\n\n"
-        "⏳ Length: 12:00:00\n"
-        "💾 Size: 1.38 GB\n"
-                     "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-
-    ),
-    "link": "https://drive.google.com/file/d/1U_yVhz5sJwXtYdgZfo_D_Kb4usSDe7YF/view"
-},
-    "🐍 Python":{
-    "description": (
-        "🐍 Python Full Course 2025 🚀\n\n"
-        "🔥 Master Python programming from scratch – perfect for beginners to advanced learners!\n\n"
-        "⏳ Length: 12:00:00\n"
-        "💾 Size: 1.44 GB\n"
-                     "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-
-    ),
-    "link": "https://drive.google.com/file/d/1CXMjGRsANgEYFgXOOQMVz0RazKzbBArz/view"
-},
-  "🌐 JavaScript":{
-    "description": (
-        "🚀 The Complete JavaScript Course 2025: From Zero to Expert! 💻\n\n"
-        "🔥 Learn JavaScript like a pro – from the absolute basics to advanced concepts, all in one course!\n\n"
-        "⏳ Length: 12:00:00\n"
-        "💾 Size: 1.48 GB\n"
-     "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-
-    ),
-    "link": "https://drive.google.com/file/d/1MbkUaXVsmcnR_7n5H12F0-DcI83NIYSy/view?usp=drive_link"
-},
-  "🎩 BlackHat Hacking":{
-    "description": (
-        "🕵️‍♂️ Black Hat Hacking Course 💻\n\n"
-        "🔥 Learn the dark side of cybersecurity – from the basics to advanced hacking techniques!\n\n"
-        "⏳ Length: 05:04:30\n"
-        "💾 Size: 516 MB\n\n"
-        "✨ Support & Share this Bot to help us grow! ❤️\n"
-                     "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-
-    ),
-    "link": "https://drive.google.com/file/d/1tU96CXdNJyCAKFgN8GvyV9oPiizVKIgm/view"
-},
-  "⚡️ PowerShell":{
-    "description": (
-        "⚡️ PowerShell Course 2025 💻\n\n"
-        "🔥 Master automation and scripting with PowerShell – from fundamentals to advanced techniques!\n\n"
-        "⏳ Length: 03:00:01\n"
-        "💾 Size: 800 MB\n\n"
-        "✨ Support & Share this Bot to help us grow! ❤️\n"
-      "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-
-    ),
-    "link": "https://drive.google.com/file/d/1VmOkMbujab1ogkPC3k9t24ws2nu1nfJH/view"
-},
- "🐧 Linux":{
-   "description": (
-        "🐧 Linux Mastery Course 2025 💻\n\n"
-        "🔥 Become a Linux pro – from beginner essentials to advanced system administration!\n\n"
-        "⏳ Length: 07:53:22\n"
-        "💾 Size: 1.29 GB\n"
-      "💡 Credit: @WinTheBetWithMe , @Paise_wala69\n"
-        "✨ Support & Share this Bot to help us grow! ❤️"
-    ),
-    "link": "https://drive.google.com/file/d/1gG3lCo_jqhRTAr7MXkrs6QqO6RPqiZCE/view"
-},
- "🎮 PUBG Hack Development":{
-   "description": (
-        "🌹 PUBG Hack Making Course – Free Download 🌹\n\n"
-        "📜 Course Topics:\n\n"
-        "🔹 Basics About App\n"
-        "🔹 Introduction to Sketchware\n"
-        "🔹 UI Design of Log Cleaner APK\n"
-        "🔹 Designing Progress 2\n"
-        "🔹 Designing Progress 3\n"
-        "🔹 UI Design Final\n"
-        "🔹 Root Permission\n"
-        "🔹 Login\n"
-        "🔹 Log Cleaner\n"
-        "🔹 Log Cleaner Final\n"
-        "🔹 Antiban APK Basic Setup\n"
-        "🔹 UI Improvement\n"
-        "🔹 Firebase Authentication\n"
-        "🔹 One Device Login\n"
-        "🔹 Dialog Box\n"
-        "🔹 Home Page Setup\n"
-        "🔹 Save & Load Key\n"
-        "🔹 Inbuilt Injector\n"
-        "🔹 Floating Icon\n"
-        "🔹 CPP Making\n"
-        "🔹 Features & Values Finding\n"
-        "🔹 Encryption & Online\n"
-        "🔹 Basic Commands & Lua\n"
-        "🔹 Completing the Script\n"
-        "🔹 Memory-Antiban\n"
-        "🔹 Fast Execution Script Making\n\n"
-        "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-    ),
-    "link": "https://www.mediafire.com/file/y78pzecdr5bmj7y/Pubg_Hack_Making_Course.rar/file"
-},
-"🗑 Binning (by BlackHat)":{
-   "description": (
-          "🎩 Binning by BlackHat Full Course 2025 (A-Z) 🎩\n"
-        "Learn advanced blackhat techniques and tools in a structured manner.\n"
-        "Full Course\n💾 Size: Check each part individually\n"
-        "Support & Share this resource to help us grow! ❤️\n\n"
-        "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-  ),
-    "link": "https://drive.google.com/drive/folders/1fQqJnMQP2GwlpaV7seqAyL19vHbZno5M"
-},
-"🤖 Android Hacking":{
-   "description": (
-          "🚀 Android Hacking Course 🔐📱\n"
-     "💡 Master Android security, exploit vulnerabilities, and level up your ethical hacking skills! ⚡️\n\n"
-             "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-  ),
-    "link": "https://drive.google.com/drive/folders/11dqpULb1h14jyoZeSwsAo_bd3XN4t602"
-},
-
-"📶 WiFi Hacking":{
-   "description": (
-              "💢 WiFi Hacking Course in Hindi 💢\n\n"
-        "📍 What you'll learn :-\n\n"
-        "🌀 Students will get the intermediate knowledge of Kali Linux and learn to crack passwords of vulnerable WiFi routers.\n\n"
-        "🌀 Attacks before gaining access to router and hiding your identity in the process.\n\n"
-        "🌀 Various methods to gain access to router.\n\n"
-        "🤓 Who this course is for:-\n"
-        "1. Anyone who wants to learn professional wireless hacking.\n"
-        "2. Penetration testing or WiFi hacking just for fun.\n\n"
-             "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-  ),
-    "link": "https://drive.google.com/folderview?id=1tgkKt4lSpXD3GnMQRgUb4bbtlmpP9XOE"
-},
-
-"🛡 Ethical Hacking":{
-   "description": (
-                "🔰 ETHICAL HACKING COURSE 🔰\n"
-                "🌀 Language ~ Hindi\n"
-                "🌀 Content - 20 Folders, 80+ videos\n"
-                "Password: ###gr3y@n0n###\n\n"
-             "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-  ),
-    "link": "http://www.mediafire.com/file/qiax38wizsnj8zm/HACK2ED+-+Tech+Vansh.rar/file"
-},
-
-"🎭 Phishing App Development":{
-   "description": (
-       
-       "This is Zpisher Famous Phishing Tool\n"
-       "apt update\n"
-       "apt upgrade\n"
-       "apt install git php openssh curl -y\n"
-       "git clone https://github.com/htr-tech/zphisher\n"
-       "cd zphisher\n"
-       "chmod +x zphisher.sh (https://zphisher.sh/)\n"
-       "bash zphisher.sh (https://zphisher.sh/)\n"
-       "run\n"
-       "cd zphisher\n"
-       "bash zphisher.sh (https://zphisher.sh/)\n\n"
-        "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-  ),
-    "link": "https://github.com/htr-tech/zphisher"
-},
-
-"📱 APK Modding (20+ Courses)":{
-   "description": (
-                  "📱 APK Modding & Game Guardian Masterclass\n\n"
-        "💻 Learn to Create, Modify, and Secure Android Apps & Games!\n\n"
-        "📚 APK Making Course\n"
-        "🎬 Beginner to Advanced Tutorials\n\n"
-        "1️⃣ Part 1 – Basics About Apps\n"
-        "2️⃣ Part 2 – Introduction to Sketchware\n"
-        "3️⃣ Part 3 – UI Design for Log Cleaner APK\n"
-        "4️⃣ Part 4 – Designing Progress (Stage 2)\n"
-        "5️⃣ Part 5 – Designing Progress (Stage 3)\n"
-        "6️⃣ Part 6 – Final UI Design\n"
-        "7️⃣ Part 7 – Root Permission Integration\n"
-        "8️⃣ Part 8 – Login System Setup\n"
-        "9️⃣ Parts 9 & 10 – Log Cleaner APK Final Build\n\n"
-        "🛡 Antiban APK Tutorials\n"
-        "1️⃣ Part 11 – Antiban APK Basic Setup\n"
-        "2️⃣ Part 12 – UI Improvement Techniques\n"
-        "3️⃣ Part 13 – Firebase Authentication\n"
-        "4️⃣ Part 14 – One Device Login System\n"
-        "5️⃣ Part 15 – Custom Dialog Box Design\n"
-        "6️⃣ Part 16 – Home Page Setup\n"
-        "7️⃣ Part 17 – Save & Load Key Functionality\n"
-        "8️⃣ Part 18 – In-Build Injector with Sketchware\n"
-        "9️⃣ Part 19 – Floating Icon Injector (Sketchware)\n\n"
-        "🖥 CPP Making Tutorial\n"
-        "Complete Guide to CPP APK Development (First & Final Video)\n\n"
-        "🎮 Game Guardian Mastery\n"
-        "🔍 Game Guardian Basics\n"
-        "Part 1 – Features & Value Finding\n\n"
-        "🧩 Game Guardian Script Making\n"
-        "1️⃣ Part 1 – Basic Commands & Lua Scripting\n"
-        "2️⃣ Part 2 – Completing the Script\n"
-        "3️⃣ Part 3 – Memory Antiban Creation\n"
-        "4️⃣ Part 4 – Fast Execution Script (XS Script)\n\n"
-        "⚡ Final Advanced Guide\n"
-        "Game Guardian Script Final Part – Encryption & Online Deployment\n\n"
-        "🔗 All Course Links\n"
-        "📥 All video links are combined in one single file for easy access!\n\n"
-             "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-  ),
-    "link": "https://pastebin.com/raw/RmnWccvp"
-},
-
-"📞 Make a Telegram Number":{
-   "description": (
-                "📲 How To Make Unlimited Numbers for Telegram or WhatsApp\n\n"
-        "💡 Follow the method carefully to generate multiple working numbers.\n\n"
-        "⭐ Watch the full video carefully to learn the method step by step.\n\n"
-        "🛡 Enjoy and use responsibly!\n\n"
-             "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-  ),
-    "link": "https://drive.google.com/file/d/1VoQYPQU2weBfhZJsMe5sHInO9HJTwSwK/view"
-},
-
-"💻 Lifetime RDP":{
-   "description": (
-       "☠️ How To Make Lifetime RDP For Free\n\n1."
-   " First Go On Chrome And Open This Website - rdphostings.com\n"
-   "2. Select Windows RDP\n"
-   "3. Select Plan - Solo Server / Expert Server ( We Prefer Expert Server )\n"
-   "4. And Then Buy it at Zero (0$) Cost , No Need To Give Any Card Details.\n"
-   "5. Fill All Real Information Of Your's.\n"
-   "6. Verify Gmail By Click On Link Which Is Send By rdphostings.com On Your Gmail Account.\n"
-   "7. Wait 24 Hours.\n"
-   "8. You Will Get Your Username And Ip on Your Gmail. And you will also get the password from Gmail itself.\n\n"
-   "And if you want to use rdp in mobile then you have to install one app. App Name is ( RD Clients )\n\n"
-   "Tip - iF You Need High Speed Internet Then Select Linux Solo Server, Speed Upto 500Mbps 😱\n\n"
-             "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-  ),
-    "link": "rdphostings.com"
-},
-
-"☎️  Call Any Indian Number Free":{
-   "description": (
-        "📞 UNLIMITED CALLS ANY INDIAN NUMBERS FOR FREE\n\n"
-        "New App Trick / Method\n\n"
-        "Any Indian Numbers Call fake number 30 Days Trial\n"
-        "Get many times trials trick leaked by hacker Alok\n"
-        "Call any Indian number for free using this trick.\n\n"
-             "💡 Credit: @WinTheBetWithMe , @Paise_wala69"
-  ),
-    "link": "https://drive.google.com/file/d/1_1qgSlxSFOshlkXaoFtcWq2G1_JTPtxX/view"
-},
-
-"💣 Own SMS Bomber":{
-   "description": (
-       "💥 CREATE YOUR OWN SMS BOMBER 💥\n\n"
-        "🚀 Learn step-by-step how to make a powerful SMS Bomber tool from scratch.\n\n"
-        "🎬 VIDEO COURSE LINK INCLUDED\n\n"
-        "💡 What You Will Learn:\n"
-        "1️⃣ Fundamentals of SMS bombing scripts and techniques.\n"
-        "2️⃣ How to safely test your tool without breaking laws.\n"
-        "3️⃣ Integrating APIs for bulk SMS sending.\n"
-        "4️⃣ Adding stylish features and customizations.\n"
-        "5️⃣ Protecting your tool from detection.\n\n"
-        "⚠️ WARNING: Use responsibly! Only for educational purposes.\n\n"
-        "✨ Credit: @WinTheBetWithMe , @Paise_wala69"
-  ),
-    "link": "https://drive.google.com/file/d/1_yvmp1Httou9u06-EjxPy5V9e2qFk9ob/view"
-},
-
-"✉️ Own Temporary Mail Bot":{
-   "description": (
-            "📬 HOW TO CREATE YOUR OWN TEMP MAIL TELEGRAM BOT 📬\n\n"
-        "🚀 Learn how to make a fully functional temporary mail bot for Telegram from scratch!\n\n"
-        "🎬 Video Tutorial Included\n"
-        "1 Download the 'Bots.Business' app from Play Store or Google.\n\n"
-        "✨ Credit: @WinTheBetWithMe , @Paise_wala69"
-  ),
-    "link": "https://drive.google.com/file/d/1nxp-k8BloK2TIQWWPAsHhqKt0ssRNvb7/view"
-},
-
-
-    # Add other courses in the same format
+class UpdateDeduplicator:
+    """Remembers the last `size` update_ids (deque + set, O(1) per check).
+
+    With a sqlite `path` the ids are also recorded on disk, so a redelivery
+    is still caught after a restart or when it lands on another worker.
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, size, path="", retention=86400):
+        self.size = size
+        self.path = path
+        self.retention = retention
+        self._ring = deque()
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._inserts = 0
+        self.checked = 0
+        self.duplicates = 0
+        self.persisted_duplicates = 0
+        self.persist_errors = 0
+        self.forgotten = 0
+        if path:
+            self._conn().execute("CREATE TABLE IF NOT EXISTS update_ids (update_id INTEGER PRIMARY KEY, seen_at REAL)")
+
+    def _conn(self):
+        # keyed by pid too: a connection inherited across fork must not be used
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _persist(self, update_id):
+        """Record the id on disk; False if it was already there."""
+        conn = self._conn()
+        now = time.time()
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO update_ids (update_id, seen_at) VALUES (?, ?)", (update_id, now)
+        ).rowcount
+        with self._lock:
+            self._inserts += 1
+            prune = self._inserts % self.PRUNE_EVERY == 0
+        if prune:
+            conn.execute("DELETE FROM update_ids WHERE seen_at < ?", (now - self.retention,))
+        return inserted == 1
+
+    def seen(self, update_id):
+        """Mark update_id as seen; True if it had been seen before (drop it)."""
+        with self._lock:
+            self.checked += 1
+            if update_id in self._seen:
+                self.duplicates += 1
+                return True
+            self._seen.add(update_id)
+            self._ring.append(update_id)
+            if len(self._ring) > self.size:
+                self._seen.discard(self._ring.popleft())
+        if self.path:
+            try:
+                if not self._persist(update_id):
+                    with self._lock:
+                        self.duplicates += 1
+                        self.persisted_duplicates += 1
+                    return True
+            except Exception as e:
+                # fail open: processing a rare duplicate beats dropping updates
+                with self._lock:
+                    self.persist_errors += 1
+                logger.warning("Update dedup store failed: %s", e)
+        return False
+
+    def forget(self, update_id):
+        """Un-mark an update that could not be queued or processed, so its redelivery is let through."""
+        with self._lock:
+            if update_id in self._seen:
+                self._seen.discard(update_id)
+                self._ring.remove(update_id)
+            self.forgotten += 1
+        if self.path:
+            try:
+                self._conn().execute("DELETE FROM update_ids WHERE update_id = ?", (update_id,))
+            except Exception as e:
+                logger.warning("Update dedup store failed: %s", e)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "checked": self.checked,
+                "forgotten": self.forgotten,
+                "duplicates": self.duplicates,
+                "persisted_duplicates": self.persisted_duplicates,
+                "persist_errors": self.persist_errors,
+                "size": len(self._ring),
+                "capacity": self.size,
+                "persistent": bool(self.path),
+            }
+
+UPDATE_DEDUP = UpdateDeduplicator(UPDATE_DEDUP_SIZE, UPDATE_DEDUP_PATH, UPDATE_DEDUP_RETENTION)
+
+# -------------------------
+# Webhook ingestion queue
+# -------------------------
+WEBHOOK_QUEUE = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+_WEBHOOK_STATS_LOCK = threading.Lock()
+WEBHOOK_STATS = {
+    "enqueued": 0,
+    "dropped": 0,
+    "processed": 0,
+    "failed": 0,
+    "wait_total": 0.0,
+    "wait_max": 0.0,
 }
 
+def _bump_webhook_stat(key, amount=1):
+    with _WEBHOOK_STATS_LOCK:
+        WEBHOOK_STATS[key] += amount
+
+def process_update(update):
+    """Run the handlers for one decoded update (sampled updates are traced)."""
+    maybe_trace(update)
+    bot.process_new_updates([update])
+
+def _webhook_worker():
+    while True:
+        enqueued_at, data = WEBHOOK_QUEUE.get()
+        wait = time.monotonic() - enqueued_at
+        with _WEBHOOK_STATS_LOCK:
+            WEBHOOK_STATS["wait_total"] += wait
+            WEBHOOK_STATS["wait_max"] = max(WEBHOOK_STATS["wait_max"], wait)
+        try:
+            update = telebot.types.Update.de_json(data)
+            process_update(update)
+            _bump_webhook_stat("processed")
+        except Exception as e:
+            UPDATE_DEDUP.forget(data.get("update_id"))
+            _bump_webhook_stat("failed")
+            logger.exception("Failed to process queued update: %s", e)
+        finally:
+            WEBHOOK_QUEUE.task_done()
+
+def enqueue_update(data):
+    """Queue a decoded update for the worker pool. Returns False if dropped."""
+    start_background_thread("webhook-worker", _webhook_worker, count=WEBHOOK_WORKERS)
+    try:
+        WEBHOOK_QUEUE.put_nowait((time.monotonic(), data))
+    except queue.Full:
+        _bump_webhook_stat("dropped")
+        logger.warning("Webhook queue full (%s), dropping update %s", WEBHOOK_QUEUE_SIZE, data.get("update_id"))
+        return False
+    _bump_webhook_stat("enqueued")
+    return True
+
+def webhook_queue_stats():
+    with _WEBHOOK_STATS_LOCK:
+        stats = dict(WEBHOOK_STATS)
+    done = stats["processed"] + stats["failed"]
+    stats["wait_avg"] = stats["wait_total"] / done if done else 0.0
+    stats["depth"] = WEBHOOK_QUEUE.qsize()
+    stats["capacity"] = WEBHOOK_QUEUE_SIZE
+    stats["workers"] = WEBHOOK_WORKERS
+    stats["enabled"] = WEBHOOK_QUEUE_ENABLED
+    return stats
+
 # -------------------------
 # Flask Routes (webhook)
 # -------------------------
@@ -1032,51 +2733,176 @@ def index():
 def set_webhook():
     bot.remove_webhook()
     full_url = f"{WEBHOOK_URL}/{BOT_TOKEN}"
-    # drop_pending_updates True helps when switching from polling to webhook or after downtime
-    bot.set_webhook(url=full_url, drop_pending_updates=True)
+    # drop_pending_updates True helps when switching from polling to webhook or after downtime.
+    # chat_member must be requested explicitly; it keeps the membership cache current.
+    bot.set_webhook(
+        url=full_url,
+        drop_pending_updates=True,
+        allowed_updates=["message", "callback_query", "chat_member"],
+    )
     return f"Webhook set to {full_url}", 200
 
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "webhook_queue": webhook_queue_stats(),
+        "update_dedup": UPDATE_DEDUP.stats(),
+        "user_cache": USER_CACHE.stats(),
+        "user_lookups": USER_LOOKUPS.stats(),
+        "member_cache": MEMBER_CACHE.stats(),
+        "member_lookups": MEMBER_LOOKUPS.stats(),
+        "message_writer": MESSAGE_WRITER.stats(),
+        "message_cleanup_pending": CLEANUP_QUEUE.qsize(),
+        "payment_dedup": PAYMENT_DEDUP_INDEX.stats(),
+        "outbox": outbox.stats(),
+        "admin_digest_pending": len(_admin_digest),
+        "connections": connection_stats(),
+        "cache_bus": dict(BUS_STATS, enabled=bool(CACHE_BUS_DIR)),
+        "scheduler": SCHEDULER.stats(),
+        "premium_index": PREMIUM_INDEX.stats(),
+    }), 200
+
+@METRICS.add_collector
+def _component_metrics():
+    caches = {cache.name: cache.stats() for cache in (USER_CACHE, MEMBER_CACHE)}
+    for name, cs in caches.items():
+        yield "bot_cache_hits_total", "counter", {"cache": name}, cs["hits"]
+    for name, cs in caches.items():
+        yield "bot_cache_misses_total", "counter", {"cache": name}, cs["misses"]
+    for name, cs in caches.items():
+        lookups = cs["hits"] + cs["misses"]
+        yield "bot_cache_hit_ratio", "gauge", {"cache": name}, cs["hits"] / lookups if lookups else 0.0
+    for name, cs in caches.items():
+        yield "bot_cache_entries", "gauge", {"cache": name}, cs["size"]
+    yield "bot_webhook_queue_depth", "gauge", {}, WEBHOOK_QUEUE.qsize()
+    yield "bot_premium_index_size", "gauge", {}, PREMIUM_INDEX.stats()["size"]
+    yield "bot_update_duplicates_total", "counter", {}, UPDATE_DEDUP.stats()["duplicates"]
+    ob = outbox.stats()
+    yield "bot_outbox_queued", "gauge", {}, ob["queued"] + ob["delayed"]
+    yield "bot_outbox_failed_total", "counter", {}, ob["failed"]
+    yield "bot_outbox_retried_429_total", "counter", {}, ob["retried_429"]
+    yield "bot_message_writer_pending", "gauge", {}, MESSAGE_WRITER.stats()["pending"]
+
+def _require_debug_token():
+    if not DEBUG_TOKEN:
+        abort(404)
+    supplied = request.headers.get("X-Debug-Token") or request.args.get("token", "")
+    if not hmac.compare_digest(supplied, DEBUG_TOKEN):
+        abort(403)
+
+@app.route("/debug/profile", methods=["GET"])
+def debug_profile():
+    _require_debug_token()
+    try:
+        seconds = float(request.args.get("seconds", "10"))
+    except ValueError:
+        return "seconds must be a number", 400
+    if not seconds > 0:
+        return "seconds must be positive", 400
+    seconds = min(seconds, PROFILE_HTTP_MAX_SECONDS, PROFILE_MAX_SECONDS)
+    try:
+        folded = PROFILER.run(seconds)
+    except RuntimeError as e:
+        return str(e), 409
+    return folded, 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+@app.route("/debug/trace", methods=["GET", "POST"])
+def debug_trace():
+    _require_debug_token()
+    if "rate" in request.args:
+        try:
+            rate = float(request.args["rate"])
+        except ValueError:
+            return "rate must be a number", 400
+        if not 0.0 <= rate <= 1.0:
+            return "rate must be between 0 and 1", 400
+        TRACE_STATE["rate"] = rate
+    with _TRACES_LOCK:
+        recent = [t.summary() for t in TRACES.values()]
+    return jsonify({"rate": TRACE_STATE["rate"], "traces": recent[::-1]}), 200
+
+@app.route("/debug/trace/<int:update_id>", methods=["GET"])
+def debug_trace_detail(update_id):
+    _require_debug_token()
+    with _TRACES_LOCK:
+        trace = TRACES.get(update_id)
+    if trace is None:
+        abort(404)
+    return jsonify(trace.to_dict()), 200
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return METRICS.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.route(f"/{BOT_TOKEN}", methods=["POST"])
 def telegram_webhook():
     # Accept content types that start with application/json (handles charset)
     content_type = request.headers.get("content-type", "")
     if not content_type.startswith("application/json"):
         abort(403)
+    start_background_work()
+    if WEBHOOK_QUEUE_ENABLED:
+        try:
+            data = json.loads(request.get_data().decode("utf-8"))
+        except Exception as e:
+            logger.warning("Rejected malformed update: %s", e)
+            return "OK", 200
+        if not isinstance(data, dict) or "update_id" not in data:
+            logger.warning("Rejected update without update_id")
+            return "OK", 200
+        if UPDATE_DEDUP.seen(data["update_id"]):
+            logger.info("Dropped redelivered update %s", data["update_id"])
+            return "OK", 200
+        if not enqueue_update(data):
+            UPDATE_DEDUP.forget(data["update_id"])
+            # not 200: Telegram keeps the update and redelivers it later
+            return "Busy", 503
+        return "OK", 200
+    update = None
     try:
         payload = request.get_data().decode("utf-8")
         update = telebot.types.Update.de_json(payload)
-        bot.process_new_updates([update])
+        # marked before processing, so a retry that arrives while this one still runs is dropped
+        if UPDATE_DEDUP.seen(update.update_id):
+            logger.info("Dropped redelivered update %s", update.update_id)
+            return "OK", 200
+        process_update(update)
     except Exception as e:
+        if update is not None:
+            UPDATE_DEDUP.forget(update.update_id)
         # log but return 200 so Telegram doesn't retry excessively
         logger.exception("Failed to process update: %s", e)
         return "OK", 200
     return "OK", 200
 
 # -------------------------
+# Auto Ping (keeps the host awake; failures back off via the scheduler)
 # -------------------------
-# Auto Ping with backoff
-# -------------------------
+AUTO_PING_INTERVAL = float(os.getenv("AUTO_PING_INTERVAL", "300"))  # seconds
+
 def auto_ping():
-    base_delay = 300  # normal interval in seconds (5 minutes)
-    max_retry_delay = 600  # max delay on failure (10 minutes)
+    if not WEBHOOK_URL:
+        return
+    response = PING_HTTP.get(WEBHOOK_URL, timeout=10)
+    if response.status_code != 200:
+        logger.warning("Auto ping returned status code %s", response.status_code)
 
-    while True:
-        try:
-            if WEBHOOK_URL:
-                response = requests.get(WEBHOOK_URL, timeout=10)
-                if response.status_code != 200:
-                    logger.warning("Auto ping returned status code %s", response.status_code)
-            # success, reset delay to normal
-            sleep_time = base_delay
-        except Exception as e:
-            logger.warning("Auto ping failed: %s", e)
-            # exponential backoff with jitter
-            sleep_time = min(base_delay * 2, max_retry_delay) + random.randint(0, 30)
-        time.sleep(sleep_time)
+SCHEDULER.every("auto-ping", AUTO_PING_INTERVAL, auto_ping, backoff_max=600, single_instance=True)
+
+def start_background_work():
+    """Start the scheduler and the cache bus in this process (idempotent, per pid).
+
+    Called by gunicorn's post_worker_init hook (gunicorn.conf.py), by the ASGI
+    startup, under app.run and, as a fallback, on each webhook request. It is
+    not called at import, so a --preload master never opens Supabase
+    connections or runs jobs that its workers would inherit.
+    """
+    SCHEDULER.start()
+    start_cache_bus()
 
 # -------------------------
 # Run Locally
 # -------------------------
 if __name__ == "__main__":
-    threading.Thread(target=auto_ping, daemon=True).start()
+    start_background_work()
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
@@ -0,0 +1,386 @@
+"""
+Data access for the users, payments and messages tables.
+
+Every query selects only the columns its caller needs. User rows used on the
+hot path (and kept in the user cache) are compact __slots__ objects instead
+of full dicts. The Async* repositories run the same queries on a supabase
+AsyncClient for async_main.
+"""
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+def _utcnow():
+    return datetime.utcnow().isoformat()
+
+
+def _seconds_before(timestamp, seconds):
+    try:
+        return (datetime.fromisoformat(timestamp) - timedelta(seconds=seconds)).isoformat()
+    except ValueError:
+        return timestamp
+
+
+# -------------------------
+# Row types
+# -------------------------
+class UserRow:
+    """The user columns every update needs: identity, status, upload flag,
+    plus the profile fields /start compares to skip redundant writes."""
+
+    __slots__ = ("id", "telegram_id", "status", "pending_upload", "username", "first_name")
+    COLUMNS = "id,telegram_id,status,pending_upload,username,first_name"
+
+    def __init__(self, id, telegram_id, status=None, pending_upload=False, username=None, first_name=None):
+        self.id = id
+        self.telegram_id = telegram_id
+        self.status = status
+        self.pending_upload = pending_upload
+        self.username = username
+        self.first_name = first_name
+
+    @classmethod
+    def from_dict(cls, row):
+        return cls(
+            row["id"], row["telegram_id"], row.get("status"), bool(row.get("pending_upload")),
+            row.get("username"), row.get("first_name"),
+        )
+
+    def with_profile(self, username, first_name):
+        return UserRow(self.id, self.telegram_id, self.status, self.pending_upload, username, first_name)
+
+    @property
+    def is_premium(self):
+        return self.status == "premium"
+
+    def __repr__(self):
+        return f"UserRow(id={self.id!r}, telegram_id={self.telegram_id!r}, status={self.status!r})"
+
+
+# -------------------------
+# Repositories
+# -------------------------
+def _rows(resp):
+    return resp.data or []
+
+
+class _Repository:
+    """Builds each query and hands it to _run(), which executes it.
+
+    Every public method is one PostgREST call, so the same code serves both
+    clients: on the sync client methods return their result, on the async
+    variants (AsyncRunner mixed in) they return an awaitable of it.
+    """
+
+    TABLE = None
+
+    def __init__(self, client):
+        self._client = client
+
+    def _table(self):
+        return self._client.table(self.TABLE)
+
+    def _run(self, query, then=_rows):
+        return then(query.execute())
+
+
+class AsyncRunner:
+    """Mixin running a repository's queries on a supabase AsyncClient."""
+
+    async def _run(self, query, then=_rows):
+        return then(await query.execute())
+
+
+class UsersRepository(_Repository):
+    TABLE = "users"
+    PREMIUM_LIST_COLUMNS = "id,telegram_id,username,first_name,last_name,status,created_at"
+    REPLICA_COLUMNS = UserRow.COLUMNS + ",updated_at"
+    # updated_at is stamped by the writer before the write commits, so a row can
+    # show up with a stamp older than the last sync: every delta re-reads this much
+    CHANGES_OVERLAP = 300  # seconds
+
+    def __init__(self, client, replica=None):
+        super().__init__(client)
+        self.replica = replica  # optional UserReplica kept current by write-through
+
+    def _first_user(self, resp):
+        rows = resp.data or []
+        return UserRow.from_dict(rows[0]) if rows else None
+
+    def get_by_telegram_id(self, telegram_id):
+        return self._run(self._table().select(UserRow.COLUMNS).eq("telegram_id", telegram_id).limit(1), self._first_user)
+
+    def get_by_id(self, user_id):
+        return self._run(self._table().select(UserRow.COLUMNS).eq("id", user_id).limit(1), self._first_user)
+
+    def get_by_username(self, username):
+        return self._run(self._table().select(UserRow.COLUMNS).eq("username", username).limit(1), self._first_user)
+
+    def register(self, telegram_id, username, first_name=None, last_name=None):
+        """Insert the user, or refresh their profile, in one upsert on telegram_id.
+
+        Only profile columns are written, so an existing user's status and
+        pending_upload are left alone. New rows rely on the column defaults
+        (status 'normal', pending_upload false, created_at now()).
+        """
+        def registered(resp):
+            if self.replica and resp.data:
+                self.replica.put(resp.data)
+            return self._first_user(resp)
+
+        return self._run(self._table().upsert({
+            "telegram_id": telegram_id,
+            "username": username,
+            "first_name": first_name,
+            "last_name": last_name,
+            "updated_at": _utcnow(),
+        }, on_conflict="telegram_id"), registered)
+
+    def _write_through(self, key_column, key, **changes):
+        def written(_resp):
+            if self.replica:
+                self.replica.update(key_column, key, **changes)
+        return written
+
+    def update_profile(self, telegram_id, username, first_name=None, last_name=None):
+        updated_at = _utcnow()
+        return self._run(self._table().update({
+            "username": username,
+            "first_name": first_name,
+            "last_name": last_name,
+            "updated_at": updated_at,
+        }).eq("telegram_id", telegram_id),
+            self._write_through("telegram_id", telegram_id, username=username, first_name=first_name, updated_at=updated_at))
+
+    def set_pending_upload(self, telegram_id, pending):
+        updated_at = _utcnow()
+        return self._run(
+            self._table().update({"pending_upload": pending, "updated_at": updated_at}).eq("telegram_id", telegram_id),
+            self._write_through("telegram_id", telegram_id, pending_upload=pending, updated_at=updated_at))
+
+    def set_premium(self, user_id):
+        updated_at = _utcnow()
+        return self._run(
+            self._table().update({"status": "premium", "updated_at": updated_at}).eq("id", user_id),
+            self._write_through("id", user_id, status="premium", updated_at=updated_at))
+
+    def page_by_id(self, after_id=None, limit=1000):
+        """Rows with REPLICA_COLUMNS ordered by id (for a full replica load)."""
+        query = self._table().select(self.REPLICA_COLUMNS)
+        if after_id is not None:
+            query = query.gt("id", after_id)
+        return self._run(query.order("id").limit(limit))
+
+    def changed_since(self, updated_at, limit=1000, columns=REPLICA_COLUMNS):
+        """Rows (REPLICA_COLUMNS by default) whose updated_at >= the given timestamp, oldest first."""
+        return self._run(self._table().select(columns).gte("updated_at", updated_at).order("updated_at").limit(limit))
+
+    def pull_changes(self, since, apply, limit=1000, columns=REPLICA_COLUMNS):
+        """Pass rows changed since `since` (less CHANGES_OVERLAP) to apply(rows), a page at a time.
+
+        Returns the new high-water mark: the newest updated_at seen, never older than `since`.
+        Several calls, so sync client only.
+        """
+        cursor = _seconds_before(since, self.CHANGES_OVERLAP)
+        while True:
+            rows = self.changed_since(cursor, limit, columns)
+            apply(rows)
+            latest = max((r["updated_at"] for r in rows if r.get("updated_at")), default=cursor)
+            since = max(since, latest)
+            # stop on a short page, or when a page of identical timestamps can't advance
+            if len(rows) < limit or latest == cursor:
+                return since
+            cursor = latest
+
+    def list_premium_ids(self, after_id=None, limit=1000):
+        """id and telegram_id of premium users ordered by id, keyset-paginated."""
+        query = self._table().select("id,telegram_id").ilike("status", "premium")
+        if after_id is not None:
+            query = query.gt("id", after_id)
+        return self._run(query.order("id").limit(limit))
+
+    def count_premium(self):
+        return self._run(self._table().select("id", count="exact").ilike("status", "premium").limit(1),
+                         lambda resp: resp.count)
+
+    def list_premium(self, after_id=None, before_id=None, limit=20):
+        """Premium users ordered by id, keyset-paginated (after_id / before_id are exclusive).
+
+        Returns plain dicts with PREMIUM_LIST_COLUMNS; `before_id` pages come
+        back in descending id order.
+        """
+        # ilike for case-insensitive match (handles 'Premium', 'premium', etc.)
+        query = self._table().select(self.PREMIUM_LIST_COLUMNS).ilike("status", "premium")
+        if before_id is not None:
+            return self._run(query.lt("id", before_id).order("id", desc=True).limit(limit))
+        if after_id is not None:
+            query = query.gt("id", after_id)
+        return self._run(query.order("id").limit(limit))
+
+
+class PaymentsRepository(_Repository):
+    TABLE = "payments"
+
+    def create(self, user_id, username, file_path, file_url, content_hash=None, file_unique_id=None):
+        """Insert an unverified payment and return its id (or None)."""
+        return self._run(self._table().insert({
+            "user_id": user_id,
+            "username": username,
+            "file_path": file_path,
+            "file_url": file_url,
+            "content_hash": content_hash,
+            "file_unique_id": file_unique_id,
+            "verified": False,
+            "created_at": _utcnow(),
+        }), lambda resp: resp.data[0].get("id") if resp.data else None)
+
+    def exists(self, user_id, column, value):
+        """True if the user has a payment whose `column` equals `value`."""
+        return self._run(self._table().select("id").eq("user_id", user_id).eq(column, value).limit(1),
+                         lambda resp: bool(resp.data))
+
+    def mark_verified(self, user_id):
+        return self._run(self._table().update({"verified": True}).eq("user_id", user_id))
+
+
+class MessagesRepository(_Repository):
+    TABLE = "messages"
+
+    def insert_many(self, rows):
+        return self._run(self._table().insert(rows))
+
+    def list_for_user(self, user_id):
+        """Return [(chat_id, message_id), ...] saved for the user."""
+        return self._run(self._table().select("chat_id,message_id").eq("user_id", user_id),
+                         lambda resp: [(r["chat_id"], r["message_id"]) for r in resp.data or []])
+
+    def delete(self, user_id, chat_id, message_ids):
+        return self._run(self._table().delete()
+                         .eq("user_id", user_id)
+                         .eq("chat_id", chat_id)
+                         .in_("message_id", list(message_ids)))
+
+
+class AsyncUsersRepository(AsyncRunner, UsersRepository):
+    def pull_changes(self, since, apply, limit=1000, columns=UsersRepository.REPLICA_COLUMNS):
+        raise NotImplementedError("replica and premium index syncs run on the sync client")
+
+
+class AsyncPaymentsRepository(AsyncRunner, PaymentsRepository):
+    pass
+
+
+class AsyncMessagesRepository(AsyncRunner, MessagesRepository):
+    pass
+
+
+# -------------------------
+# Local read replica
+# -------------------------
+class UserReplica:
+    """SQLite mirror of the users table's hot columns, for sub-millisecond reads.
+
+    One file is shared by every worker on the host (WAL mode, one connection
+    per thread). It is filled by sync_from() -- a full load the first time,
+    then deltas by updated_at -- and kept current between syncs by
+    UsersRepository's write-through. Rows never move backwards in updated_at.
+    Deltas come from UsersRepository.pull_changes, which re-reads an overlap
+    window so late-committing rows are not missed.
+    """
+
+    FIELDS = ("telegram_id", "id", "status", "pending_upload", "username", "first_name", "updated_at")
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " telegram_id INTEGER PRIMARY KEY, id INTEGER, status TEXT, pending_upload INTEGER,"
+            " username TEXT, first_name TEXT, updated_at TEXT)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS users_id ON users (id)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _conn(self):
+        # keyed by pid too: a connection inherited across fork must not be used
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _meta(self, key):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._conn().execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    @property
+    def ready(self):
+        """True once a full load has completed; reads before that should go to the DB."""
+        return self._meta("synced_at") is not None
+
+    def get(self, telegram_id):
+        row = self._conn().execute(
+            "SELECT id, telegram_id, status, pending_upload, username, first_name FROM users WHERE telegram_id = ?",
+            (telegram_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return UserRow(row[0], row[1], row[2], bool(row[3]), row[4], row[5])
+
+    def put(self, rows):
+        """Upsert users rows (dicts); older versions never replace newer ones."""
+        self._conn().executemany(
+            "INSERT INTO users (telegram_id, id, status, pending_upload, username, first_name, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (telegram_id) DO UPDATE SET"
+            " id = excluded.id, status = excluded.status, pending_upload = excluded.pending_upload,"
+            " username = excluded.username, first_name = excluded.first_name, updated_at = excluded.updated_at"
+            " WHERE users.updated_at IS NULL OR excluded.updated_at IS NULL OR excluded.updated_at >= users.updated_at",
+            [
+                (r["telegram_id"], r["id"], r.get("status"), int(bool(r.get("pending_upload"))),
+                 r.get("username"), r.get("first_name"), r.get("updated_at"))
+                for r in rows
+            ],
+        )
+
+    def update(self, key_column, key, **changes):
+        """Apply a write we just made to Supabase (key_column is 'id' or 'telegram_id')."""
+        assert key_column in ("id", "telegram_id") and set(changes) <= set(self.FIELDS)
+        columns = ", ".join(f"{c} = ?" for c in changes)
+        values = [int(v) if isinstance(v, bool) else v for v in changes.values()]
+        self._conn().execute(f"UPDATE users SET {columns} WHERE {key_column} = ?", (*values, key))
+
+    def sync_from(self, users_repo, page_size=1000):
+        """Pull changes from Supabase (everything on the first run). Returns rows applied."""
+        since = self._meta("max_updated_at")
+        applied = 0
+        if since is None:
+            # rows changed while the load pages through are re-read by the next delta
+            since = _utcnow()
+            after_id = None
+            while True:
+                rows = users_repo.page_by_id(after_id, page_size)
+                self.put(rows)
+                applied += len(rows)
+                if len(rows) < page_size:
+                    break
+                after_id = rows[-1]["id"]
+        else:
+            def apply(rows):
+                nonlocal applied
+                self.put(rows)
+                applied += len(rows)
+            since = users_repo.pull_changes(since, apply, page_size)
+        if since:
+            self._set_meta("max_updated_at", since)
+        self._set_meta("synced_at", str(time.time()))
+        return applied